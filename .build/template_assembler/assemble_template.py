@@ -1,11 +1,48 @@
 from PIL import Image, ImageDraw
 import os
 import sys
-import urllib.request
+import urllib.error
 import urllib.parse
+import http.client
+import http.server
+import io
+import threading
+import concurrent.futures
+import multiprocessing
+import hashlib
+import shutil
+import time
+import argparse
+import contextlib
+import itertools
+import collections
+import traceback
+import cProfile
 import json
 import datetime
 import math
+import struct
+import zlib
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # no advisory locks on windows, concurrent builds there may drop each other's cache entries
+    fcntl = None
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, peak memory is reported as unknown there
+    resource = None
+
+try:
+    import watchdog.events
+    import watchdog.observers
+except ImportError:
+    # optional, --watch polls the watched files instead
+    watchdog = None
 
 palettes = [
     set([ # 2k x 2k palette from 2022
@@ -44,14 +81,532 @@ palettes = [
     ]),
 ]
 
-canvasSize = (1000, 1000)
+# templates can override this with "canvas_size": [width, height]
+defaultCanvasSize = (1000, 1000)
+canvasSize = defaultCanvasSize
+
+# --no-cull draws every entry, even ones that later entries cover completely. workers decode entries ahead of
+# the render loop, None is one per cpu, see --workers
+renderSettings = {"cull": True, "workers": None}
+
+# how output PNGs are written, see the --encoding, --compress-level, --optimize, --compare-encodings, --tile-size
+# and --hashed-outputs options
+outputSettings = {"encoding": "paletted", "compress_level": 9, "optimize": False, "compare": False, "tile_size": 0,
+    "deltas": True, "delta_max_bytes": 1048576, "delta_max_age": 48 * 3600, "hashed": False}
+
 palette = palettes[0]
 
+# iteration order of the palette set decides ties, so the arrays keep that order
+paletteArray = np.array(list(palette), dtype=np.uint8)
+paletteKeys = paletteArray.view(np.uint32).reshape(-1)
+perceptualWeights = np.array([0.3, 0.59, 0.11])
+nearestColorChunk = 65536
+
+requestHeaders = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/113.0",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
+}
+fetchWorkers = 16
+fetchRedirectLimit = 5
+fetchChunkSize = 65536
+
+# per request timeouts, by default and for particular hosts (as in the url, with the port if there is one),
+# how long a whole build may spend fetching, and how many failures in a row take a host out of the build.
+# see --fetch-timeout, --host-timeout, --deadline and --breaker-failures
+fetchSettings = {"timeout": 5, "host_timeouts": dict(), "deadline": 120, "breaker_failures": 3}
+lastGoodMaxDays = 7
+
+# budgets for a single source image, checked while it is downloaded and on its header before it is decoded.
+# the pixel budget never goes below the canvas area, see --source-max-mb and --source-max-pixels
+sourceLimits = {"bytes": 16 * 1048576, "pixels": 4096 * 4096}
+
+defaultCacheDir = ".build/template_assembler/cache"
+defaultCacheMegabytes = 512
+cacheFormatVersion = 1
+
+# on-disk cache shared by all fetch sites. response bodies are stored by content hash along with the
+# validators needed for conditional GETs, and normalized images are stored by the hash of the bytes
+# they were decoded from. objects are evicted least recently used first once over maxBytes
+class FetchCache:
+    def __init__(self, cacheDir, maxBytes):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.index = self.readIndex()
+    
+    def readIndex(self):
+        indexPath = os.path.join(self.cacheDir, "index.json")
+        if os.path.isfile(indexPath):
+            try:
+                with open(indexPath, "r", encoding="utf-8") as f:
+                    index = json.loads(f.read())
+                if index["version"] == cacheFormatVersion:
+                    return index
+            except Exception as e:
+                print("Ignoring unreadable cache index {0}: {1}".format(indexPath, e))
+        return {"version": cacheFormatVersion, "urls": dict(), "objects": dict()}
+    
+    def getTemporaryPath(self, filePath):
+        # several builds can share the cache, so temporary files are per process
+        return "{0}.{1}.tmp".format(filePath, os.getpid())
+    
+    def getObjectPath(self, objectName):
+        return os.path.join(self.cacheDir, *objectName.split("/"))
+    
+    def readObject(self, objectName):
+        # callers hold the lock
+        if not objectName in self.index["objects"]:
+            return None
+        try:
+            with open(self.getObjectPath(objectName), "rb") as f:
+                data = f.read()
+        except OSError:
+            del self.index["objects"][objectName]
+            return None
+        self.index["objects"][objectName]["last_used"] = time.time()
+        return data
+    
+    def writeObject(self, objectName, data, details = dict()):
+        # callers hold the lock
+        objectPath = self.getObjectPath(objectName)
+        os.makedirs(os.path.dirname(objectPath), exist_ok = True)
+        temporaryPath = self.getTemporaryPath(objectPath)
+        with open(temporaryPath, "wb") as f:
+            f.write(data)
+        os.replace(temporaryPath, objectPath)
+        self.index["objects"][objectName] = dict(details, size = len(data), last_used = time.time())
+    
+    def getValidators(self, url):
+        headers = dict()
+        with self.lock:
+            if url in self.index["urls"] and "blobs/" + self.index["urls"][url]["hash"] in self.index["objects"]:
+                urlInfo = self.index["urls"][url]
+                if urlInfo["etag"]:
+                    headers["If-None-Match"] = urlInfo["etag"]
+                if urlInfo["last_modified"]:
+                    headers["If-Modified-Since"] = urlInfo["last_modified"]
+        return headers
+    
+    def getBody(self, url):
+        with self.lock:
+            if not url in self.index["urls"]:
+                return None
+            return self.readObject("blobs/" + self.index["urls"][url]["hash"])
+    
+    def storeBody(self, url, body, etag, lastModified):
+        contentHash = hashlib.sha256(body).hexdigest()
+        with self.lock:
+            if not "blobs/" + contentHash in self.index["objects"]:
+                self.writeObject("blobs/" + contentHash, body)
+            self.index["urls"][url] = {"hash": contentHash, "etag": etag, "last_modified": lastModified}
+    
+    def hasImage(self, kind, key):
+        with self.lock:
+            return kind + "/" + key in self.index["objects"]
+    
+    def getImageDetails(self, kind, key):
+        with self.lock:
+            return self.index["objects"].get(kind + "/" + key)
+    
+    def loadImage(self, kind, key):
+        objectName = kind + "/" + key
+        with self.lock:
+            data = self.readObject(objectName)
+            if data is None:
+                return None
+            details = self.index["objects"][objectName]
+        image = Image.frombytes(details.get("mode", "RGBA"), (details["width"], details["height"]), data)
+        return (image, details)
+    
+    def storeImage(self, kind, key, image, details = dict()):
+        with self.lock:
+            self.writeObject(kind + "/" + key, image.tobytes(), dict(details, width = image.width, height = image.height, mode = image.mode))
+    
+    def getLastGoodPath(self, url):
+        return os.path.join(self.cacheDir, "last_good", hashlib.sha256(url.encode("utf-8")).hexdigest())
+    
+    def storeLastGood(self, url, body):
+        # the last body of url that was actually used, kept apart from the size limit so a build that can't
+        # reach the host still has it. the modification time says when it was last good
+        lastGoodPath = self.getLastGoodPath(url)
+        if os.path.isfile(lastGoodPath) and os.path.getsize(lastGoodPath) == len(body) and hashFile(lastGoodPath) == hashlib.sha256(body).hexdigest():
+            os.utime(lastGoodPath)
+            return
+        os.makedirs(os.path.dirname(lastGoodPath), exist_ok = True)
+        temporaryPath = self.getTemporaryPath(lastGoodPath)
+        with open(temporaryPath, "wb") as f:
+            f.write(body)
+        os.replace(temporaryPath, lastGoodPath)
+    
+    def loadLastGood(self, url):
+        lastGoodPath = self.getLastGoodPath(url)
+        try:
+            lastGoodTime = os.path.getmtime(lastGoodPath)
+            if time.time() - lastGoodTime > lastGoodMaxDays * 86400:
+                return None
+            with open(lastGoodPath, "rb") as f:
+                return (f.read(), lastGoodTime)
+        except OSError:
+            return None
+    
+    def pruneLastGood(self):
+        lastGoodDir = os.path.join(self.cacheDir, "last_good")
+        if not os.path.isdir(lastGoodDir):
+            return
+        for fileName in os.listdir(lastGoodDir):
+            try:
+                if time.time() - os.path.getmtime(os.path.join(lastGoodDir, fileName)) > lastGoodMaxDays * 86400:
+                    os.remove(os.path.join(lastGoodDir, fileName))
+            except OSError:
+                pass
+    
+    def getBuildStatePath(self, subfolder):
+        folderKey = hashlib.sha256(os.path.abspath(subfolder).encode("utf-8")).hexdigest()[0:16]
+        return os.path.join(self.cacheDir, "builds", folderKey + ".json")
+    
+    def loadBuildState(self, subfolder):
+        try:
+            with open(self.getBuildStatePath(subfolder), "r", encoding="utf-8") as f:
+                return json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+    
+    def storeBuildState(self, subfolder, buildState):
+        statePath = self.getBuildStatePath(subfolder)
+        os.makedirs(os.path.dirname(statePath), exist_ok = True)
+        temporaryPath = self.getTemporaryPath(statePath)
+        with open(temporaryPath, "w", encoding="utf-8") as f:
+            f.write(json.dumps(buildState))
+        os.replace(temporaryPath, statePath)
+    
+    def evict(self):
+        # callers hold the lock
+        objects = self.index["objects"]
+        totalBytes = sum(details["size"] for details in objects.values())
+        for objectName in sorted(objects, key = lambda name: objects[name]["last_used"]):
+            if totalBytes <= self.maxBytes:
+                break
+            totalBytes -= objects[objectName]["size"]
+            del objects[objectName]
+            try:
+                os.remove(self.getObjectPath(objectName))
+            except OSError:
+                pass
+        
+        # forget validators whose body is gone, or a 304 would leave nothing to return
+        self.index["urls"] = {url: urlInfo for (url, urlInfo) in self.index["urls"].items() if "blobs/" + urlInfo["hash"] in objects}
+    
+    def mergeIndex(self, diskIndex):
+        # callers hold the lock. keeps what other builds added since this one loaded the index
+        objects = self.index["objects"]
+        for (objectName, details) in diskIndex["objects"].items():
+            if objectName in objects:
+                objects[objectName]["last_used"] = max(objects[objectName]["last_used"], details["last_used"])
+            elif os.path.isfile(self.getObjectPath(objectName)):
+                objects[objectName] = details
+        
+        for (url, urlInfo) in diskIndex["urls"].items():
+            if not url in self.index["urls"]:
+                self.index["urls"][url] = urlInfo
+    
+    def save(self):
+        os.makedirs(self.cacheDir, exist_ok = True)
+        indexPath = os.path.join(self.cacheDir, "index.json")
+        with self.lock, open(os.path.join(self.cacheDir, "index.lock"), "w") as lockFile:
+            if fcntl:
+                fcntl.flock(lockFile, fcntl.LOCK_EX)
+            self.mergeIndex(self.readIndex())
+            self.evict()
+            temporaryPath = self.getTemporaryPath(indexPath)
+            with open(temporaryPath, "w", encoding="utf-8") as f:
+                f.write(json.dumps(self.index))
+            os.replace(temporaryPath, indexPath)
+        self.pruneLastGood()
+    
+    def describe(self):
+        with self.lock:
+            objects = self.index["objects"]
+            for kind in ["blobs", "normalized", "masks", "coverage"]:
+                sizes = [details["size"] for (objectName, details) in objects.items() if objectName.startswith(kind + "/")]
+                print("{0}: {1} objects, {2:.1f} MB".format(kind, len(sizes), sum(sizes) / 1048576))
+            print("limit: {0:.1f} MB in {1}".format(self.maxBytes / 1048576, self.cacheDir))
+            lastGoodDir = os.path.join(self.cacheDir, "last_good")
+            if os.path.isdir(lastGoodDir):
+                sizes = [os.path.getsize(os.path.join(lastGoodDir, fileName)) for fileName in os.listdir(lastGoodDir)]
+                print("last good copies: {0}, {1:.1f} MB, not counted against the limit".format(len(sizes), sum(sizes) / 1048576))
+            for (url, urlInfo) in sorted(self.index["urls"].items()):
+                print("\t{0} {1} etag={2} last-modified={3}".format(urlInfo["hash"][0:12], url, urlInfo["etag"], urlInfo["last_modified"]))
+    
+    def clear(self):
+        with self.lock:
+            if os.path.isdir(self.cacheDir):
+                shutil.rmtree(self.cacheDir)
+            self.index = {"version": cacheFormatVersion, "urls": dict(), "objects": dict()}
+
+def isTransientFetchError(error):
+    # the host may well answer next time. a 4xx or a source over budget is an answer
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code >= 500
+    return isinstance(error, (OSError, http.client.HTTPException))
+
+def getBuildDeadline():
+    if fetchSettings["deadline"] <= 0:
+        return None
+    return time.time() + fetchSettings["deadline"]
+
+# downloads remote resources on a bounded thread pool. each url is downloaded at most once and every
+# worker keeps one keep-alive connection per host. fetch() blocks until that url is available,
+# prefetch() only queues downloads so they overlap with whatever the caller does next.
+# nothing is fetched past the deadline (a time.time() value), hosts that keep failing are skipped, and
+# urls that can't be fetched fall back to the last copy that was good enough to use, see remember()
+class RemoteFetcher:
+    def __init__(self, workers = fetchWorkers, cache = None, preloaded = dict(), deadline = None):
+        self.cache = cache
+        self.deadline = deadline
+        self.hostFailures = dict()
+        self.stale = dict()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = workers)
+        self.lock = threading.Lock()
+        self.downloads = dict()
+        self.statistics = dict()
+        
+        # results another fetcher already got, see getResults
+        for (url, result) in preloaded.items():
+            self.downloads[url] = concurrent.futures.Future()
+            if isinstance(result, Exception):
+                self.downloads[url].set_exception(result)
+            else:
+                self.downloads[url].set_result(result)
+            self.statistics[url] = {"seconds": 0, "bytes": 0, "status": "preloaded", "retries": 0}
+        self.connections = []
+        self.threadState = threading.local()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exceptionInfo):
+        self.close()
+    
+    def close(self):
+        self.executor.shutdown(wait = True, cancel_futures = True)
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+        if self.cache:
+            self.cache.save()
+    
+    def submit(self, url):
+        with self.lock:
+            if not url in self.downloads:
+                self.downloads[url] = self.executor.submit(self.download, url)
+            return self.downloads[url]
+    
+    def prefetch(self, urls):
+        for url in urls:
+            self.submit(url)
+    
+    def fetch(self, url):
+        try:
+            return self.waitFor(self.submit(url))
+        except Exception as e:
+            lastGood = self.cache.loadLastGood(url) if self.cache and isTransientFetchError(e) else None
+            if lastGood is None:
+                raise
+            (body, lastGoodTime) = lastGood
+            with self.lock:
+                self.stale[url] = {"utc": int(lastGoodTime), "error": str(e)}
+            print("\tusing the last good copy of {0} from {1:.1f}h ago: {2}".format(url, (time.time() - lastGoodTime) / 3600, e))
+            return body
+    
+    def waitFor(self, download):
+        if self.deadline is None:
+            return download.result()
+        try:
+            return download.result(timeout = max(0, self.deadline - time.time()))
+        except concurrent.futures.TimeoutError:
+            if download.done():
+                raise
+            raise TimeoutError("build deadline reached while downloading")
+    
+    def remember(self, url, body):
+        # body turned out to be usable, keep it for builds that can't get url
+        if self.cache and url.startswith("http") and not url in self.stale:
+            self.cache.storeLastGood(url, body)
+    
+    def getTimeout(self, host):
+        # the host's own timeout, cut short by the deadline
+        timeout = fetchSettings["host_timeouts"].get(host, fetchSettings["timeout"])
+        if self.deadline is not None:
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                raise TimeoutError("build deadline reached before fetching from {0}".format(host))
+            timeout = min(timeout, remaining)
+        return timeout
+    
+    def checkHost(self, host):
+        with self.lock:
+            failures = self.hostFailures.get(host, 0)
+        if failures >= fetchSettings["breaker_failures"]:
+            raise urllib.error.URLError("{0} failed {1} times in a row, not trying it again this build".format(host, failures))
+    
+    def recordHostResult(self, host, error):
+        with self.lock:
+            if error is None:
+                self.hostFailures[host] = 0
+            elif isTransientFetchError(error) and self.hostFailures.get(host, 0) < fetchSettings["breaker_failures"]:
+                self.hostFailures[host] = self.hostFailures.get(host, 0) + 1
+    
+    def getOpenCircuits(self):
+        with self.lock:
+            return sorted(host for (host, failures) in self.hostFailures.items() if failures >= fetchSettings["breaker_failures"])
+    
+    def getResults(self):
+        # every download as bytes or the exception it failed with, in a form that can be sent to another process
+        with self.lock:
+            downloads = list(self.downloads.items())
+        concurrent.futures.wait([download for (url, download) in downloads])
+        
+        results = dict()
+        for (url, download) in downloads:
+            if download.cancelled():
+                continue
+            if download.exception() is not None:
+                # keeps whether it is worth falling back to a last good copy
+                errorType = OSError if isTransientFetchError(download.exception()) else RuntimeError
+                results[url] = errorType(str(download.exception()))
+            else:
+                results[url] = download.result()
+        return results
+    
+    def getConnection(self, scheme, host):
+        if not hasattr(self.threadState, "connections"):
+            self.threadState.connections = dict()
+        key = (scheme, host)
+        if not key in self.threadState.connections:
+            connectionType = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+            connection = connectionType(host, timeout = fetchSettings["timeout"])
+            self.threadState.connections[key] = connection
+            with self.lock:
+                self.connections.append(connection)
+        return self.threadState.connections[key]
+    
+    def request(self, scheme, host, path, headers, statistics):
+        connection = self.getConnection(scheme, host)
+        for attempt in range(0, 2):
+            connection.timeout = self.getTimeout(host)
+            if connection.sock is not None:
+                connection.sock.settimeout(connection.timeout)
+            try:
+                connection.request("GET", path, headers = headers)
+                return connection.getresponse()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                # the server dropped an idle keep-alive connection, retry once on a fresh one
+                connection.close()
+                if attempt == 1:
+                    raise
+                statistics["retries"] += 1
+            except:
+                connection.close()
+                raise
+    
+    def download(self, url):
+        statistics = {"seconds": 0, "bytes": 0, "status": None, "retries": 0}
+        startTime = time.perf_counter()
+        host = urllib.parse.urlsplit(url).netloc
+        try:
+            self.checkHost(host)
+            body = self.transfer(url, statistics)
+            self.recordHostResult(host, None)
+            return body
+        except Exception as e:
+            statistics["error"] = str(e)
+            self.recordHostResult(host, e)
+            raise
+        finally:
+            statistics["seconds"] = time.perf_counter() - startTime
+            with self.lock:
+                self.statistics[url] = statistics
+    
+    def transfer(self, url, statistics):
+        headers = dict(requestHeaders)
+        if self.cache:
+            headers.update(self.cache.getValidators(url))
+        
+        target = url
+        for redirect in range(0, fetchRedirectLimit + 1):
+            parsed = urllib.parse.urlsplit(target)
+            if not parsed.scheme in ["http", "https"]:
+                raise ValueError("unsupported url {0}".format(target))
+            
+            path = urllib.parse.urlunsplit(("", "", parsed.path or "/", parsed.query, ""))
+            response = self.request(parsed.scheme, parsed.netloc, path, headers, statistics)
+            try:
+                body = self.readBody(response, target, statistics)
+            except:
+                # the rest of the body is still on the wire, the connection can't be reused
+                self.getConnection(parsed.scheme, parsed.netloc).close()
+                raise
+            statistics["status"] = response.status
+            
+            if response.status in [301, 302, 303, 307, 308] and response.getheader("Location"):
+                target = urllib.parse.urljoin(target, response.getheader("Location"))
+                continue
+            if response.status == 304 and self.cache:
+                cachedBody = self.cache.getBody(url)
+                if cachedBody is not None:
+                    return cachedBody
+                # evicted in the meantime, ask again without validators
+                headers = dict(requestHeaders)
+                target = url
+                continue
+            if response.status >= 400:
+                raise urllib.error.HTTPError(target, response.status, response.reason, response.headers, None)
+            if self.cache:
+                self.cache.storeBody(url, body, response.getheader("ETag"), response.getheader("Last-Modified"))
+            return body
+        raise urllib.error.URLError("too many redirects for {0}".format(url))
+    
+    def readBody(self, response, url, statistics):
+        # gives up as soon as the body is known to be over budget, either from its length or from the
+        # image header at its start
+        contentLength = response.getheader("Content-Length")
+        if contentLength is not None and contentLength.isdigit() and int(contentLength) > sourceLimits["bytes"]:
+            raise ValueError("{0} is {1} bytes, over the budget of {2}".format(url, contentLength, sourceLimits["bytes"]))
+        
+        chunks = []
+        received = 0
+        headerChecked = False
+        while True:
+            chunk = response.read(fetchChunkSize)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            received += len(chunk)
+            statistics["bytes"] += len(chunk)
+            if received > sourceLimits["bytes"]:
+                raise ValueError("{0} is over the budget of {1} bytes".format(url, sourceLimits["bytes"]))
+            if self.deadline is not None and time.time() > self.deadline:
+                raise TimeoutError("build deadline reached while downloading {0}".format(url))
+            if not headerChecked and received >= fetchChunkSize:
+                headerChecked = True
+                header = peekSourceHeader(b"".join(chunks))
+                if header is not None:
+                    checkSourcePixelBudget(header)
+        return b"".join(chunks)
+
 def loadTemplate(subfolder):
     with open(os.path.join(subfolder, "template.json"), "r", encoding="utf-8") as f:
         template = json.loads(f.read())
     return template
 
+def getCanvasSize(templateFile):
+    if not "canvas_size" in templateFile:
+        return defaultCanvasSize
+    (width, height) = (int(templateFile["canvas_size"][0]), int(templateFile["canvas_size"][1]))
+    if width <= 0 or height <= 0:
+        raise ValueError("invalid canvas_size {0}".format(templateFile["canvas_size"]))
+    return (width, height)
+
 
 def createImage(size, isMask):
     alphaValue = 0
@@ -59,28 +614,205 @@ def createImage(size, isMask):
         alphaValue = 255
     return Image.new("RGBA", size, (0, 0, 0, alphaValue)) 
 
-def createCanvas(isMask = False):
-    return createImage(canvasSize, isMask)
+# while compositing, canvas, autopick and every export group are planes of palette indices (see getPaletteIndices)
+# and the mask is a plane of priorities, one byte per pixel. normalized images only hold palette colors or
+# full transparency, so this is exact. they only become images when they are written
+def createPlane(size):
+    return np.zeros((size[1], size[0]), dtype=np.uint8)
+
+def getPlaneSize(plane):
+    return (plane.shape[1], plane.shape[0])
 
-def copyTemplateEntryIntoCanvas(templateEntry, image, canvas):
-    if (templateEntry["x"] + image.width > canvasSize[0] or
-        templateEntry["y"] + image.height > canvasSize[1] or
+def checkTemplateEntryOnCanvas(templateEntry, size):
+    if (templateEntry["x"] + size[0] > canvasSize[0] or
+        templateEntry["y"] + size[1] > canvasSize[1] or
         templateEntry["x"] < 0 or
         templateEntry["y"] < 0):
         raise ValueError("{0} is not entirely on canvas?? {1}".format(templateEntry["name"], templateEntry))
+
+def paintPlane(plane, origin, templateEntry, opaque, values):
+    # sets the entry's opaque pixels in a plane whose top left corner is at origin on the canvas. values is
+    # either a plane the size of the entry or a single value, 0 erases
+    x1 = max(templateEntry["x"], origin[0])
+    y1 = max(templateEntry["y"], origin[1])
+    x2 = min(templateEntry["x"] + opaque.shape[1], origin[0] + plane.shape[1])
+    y2 = min(templateEntry["y"] + opaque.shape[0], origin[1] + plane.shape[0])
+    if x2 <= x1 or y2 <= y1:
+        return
+    
+    region = plane[y1 - origin[1]:y2 - origin[1], x1 - origin[0]:x2 - origin[0]]
+    entryRows = slice(y1 - templateEntry["y"], y2 - templateEntry["y"])
+    entryColumns = slice(x1 - templateEntry["x"], x2 - templateEntry["x"])
+    entryOpaque = opaque[entryRows, entryColumns]
+    if isinstance(values, np.ndarray):
+        region[entryOpaque] = values[entryRows, entryColumns][entryOpaque]
+    else:
+        region[entryOpaque] = values
+
+def paintOutputs(planes, origin, templateEntry, indices, opaque, priorityValues):
+    # what drawing an entry does to canvas, autopick and mask. priorityValues is None unless it is autopicked
+    paintPlane(planes["canvas"], origin, templateEntry, opaque, indices)
+    
+    if priorityValues is not None:
+        paintPlane(planes["autopick"], origin, templateEntry, opaque, indices)
+        paintPlane(planes["mask"], origin, templateEntry, opaque, priorityValues)
+    else:
+        paintPlane(planes["autopick"], origin, templateEntry, opaque, 0)
+        paintPlane(planes["mask"], origin, templateEntry, opaque, 0)
+
+def hashImagePixels(image):
+    pixelHash = hashlib.sha256("{0}x{1}".format(image.width, image.height).encode("utf-8"))
+    pixelHash.update(image.tobytes())
+    return pixelHash.hexdigest()
+
+def hashFile(filePath):
+    try:
+        with open(filePath, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+def getPaletteIndices(pixels):
+    # index 0 is transparent and index i + 1 is paletteArray[i]. every pixel must map exactly, None otherwise
+    transparent = pixels[..., 3] == 0
+    
+    paletteOrder = np.argsort(paletteKeys)
+    sortedKeys = paletteKeys[paletteOrder]
+    pixelKeys = packPixels(pixels)
+    positions = np.minimum(np.searchsorted(sortedKeys, pixelKeys), len(sortedKeys) - 1)
+    if not np.all(transparent | (sortedKeys[positions] == pixelKeys)):
+        return None
     
-    canvas.alpha_composite(image, (templateEntry["x"], templateEntry["y"]))
+    return np.where(transparent, 0, paletteOrder[positions] + 1).astype(np.uint8)
 
-def eraseFromCanvas(templateEntry, maskImage, canvas, isMask = False):
-    blankImage = createImage((maskImage.width, maskImage.height), isMask)
-    canvas.paste(blankImage, (templateEntry["x"], templateEntry["y"]), maskImage)
+def getEncodingKey():
+    return "{0}-{1}-{2}".format(outputSettings["encoding"], outputSettings["compress_level"], outputSettings["optimize"])
+
+def getOutputPalette():
+    return [0, 0, 0] + paletteArray[:, 0:3].reshape(-1).tolist()
+
+def convertPlaneToImage(plane, isMask = False):
+    # the image a plane is saved as: palette indices with index 0 transparent, or grayscale with alpha for
+    # the mask. --encoding rgba expands both to RGBA
+    if isMask:
+        encodedImage = Image.frombytes("LA", getPlaneSize(plane), np.dstack([plane, np.full(plane.shape, 255, dtype=np.uint8)]).tobytes())
+    else:
+        encodedImage = Image.frombytes("P", getPlaneSize(plane), np.ascontiguousarray(plane).tobytes())
+        encodedImage.putpalette(getOutputPalette(), "RGB")
+        encodedImage.info["transparency"] = 0
+    
+    if outputSettings["encoding"] == "rgba":
+        with encodedImage:
+            return encodedImage.convert("RGBA")
+    return encodedImage
+
+def saveEncoded(encodedImage, fileOrPath):
+    saveOptions = {"format": "PNG", "compress_level": outputSettings["compress_level"], "optimize": outputSettings["optimize"]}
+    if encodedImage.mode == "P":
+        saveOptions["transparency"] = 0
+    encodedImage.save(fileOrPath, **saveOptions)
+
+def writeEncoded(encodedImage, subfolder, name, buildState = None, report = None):
+    # returns the hash of the written file
+    filePath = os.path.join(subfolder, name + ".png")
+    
+    # incremental builds leave a file alone when it is still the one the last build wrote for these pixels
+    if buildState is not None:
+        pixelHash = hashImagePixels(encodedImage)
+        previousOutput = buildState["previous"].get(name)
+        if (previousOutput is not None and previousOutput["pixels"] == pixelHash and
+            previousOutput.get("encoding") == getEncodingKey() and previousOutput["file"] == hashFile(filePath)):
+            buildState["outputs"][name] = previousOutput
+            return previousOutput["file"]
+        buildState["changed"] = True
+    
+    startTime = time.perf_counter()
+    saveEncoded(encodedImage, filePath)
+    encodeTime = time.perf_counter() - startTime
+    fileHash = hashFile(filePath)
+    
+    if report is not None:
+        outputReport = {"encoding": encodedImage.mode, "bytes": os.path.getsize(filePath), "encode_seconds": encodeTime}
+        if outputSettings["compare"]:
+            # what the same pixels cost as a default RGBA PNG, the way outputs used to be written
+            with encodedImage.convert("RGBA") as rgbaImage, io.BytesIO() as rgbaOutput:
+                startTime = time.perf_counter()
+                rgbaImage.save(rgbaOutput, format = "PNG")
+                outputReport["rgba_encode_seconds"] = time.perf_counter() - startTime
+                outputReport["rgba_bytes"] = rgbaOutput.tell()
+        report.outputs[name] = outputReport
+    
+    if buildState is not None:
+        buildState["outputs"][name] = {"pixels": pixelHash, "encoding": getEncodingKey(), "file": fileHash}
+    return fileHash
 
-def writeCanvas(canvas, subfolder, name):
-    canvas.save(os.path.join(subfolder, name + ".png"))
-    if False:
-        canvas.save(os.path.join(subfolder, name + "_u.png"))
-        with canvas.quantize() as quantizedCanvas:
-            quantizedCanvas.save(os.path.join(subfolder, name + ".png"))
+def writePlane(plane, subfolder, name, buildState = None, report = None, isMask = False):
+    with convertPlaneToImage(plane, isMask) as encodedImage:
+        return writeEncoded(encodedImage, subfolder, name, buildState, report)
+
+def writeTextOutput(filePath, outputText, buildState = None):
+    if buildState is not None:
+        if os.path.isfile(filePath):
+            with open(filePath, "r", encoding="utf-8") as f:
+                if f.read() == outputText:
+                    return
+        buildState["changed"] = True
+    
+    with open(filePath, "w", encoding="utf-8") as f:
+        f.write(outputText)
+
+
+tileFolder = "tiles"
+
+def getTileRectangles():
+    tileSize = outputSettings["tile_size"]
+    tileRectangles = []
+    for y in range(0, canvasSize[1], tileSize):
+        for x in range(0, canvasSize[0], tileSize):
+            tileRectangles.append((x, y, min(x + tileSize, canvasSize[0]), min(y + tileSize, canvasSize[1])))
+    return tileRectangles
+
+def writeTiles(planes, subfolder, buildState = None, report = None):
+    # tiles are slices of the planes, so only one tile is ever expanded into an image at a time. returns
+    # the files written, tiles.json included
+    tileSize = outputSettings["tile_size"]
+    tileFiles = []
+    manifestPath = os.path.join(subfolder, "tiles.json")
+    tilePath = os.path.join(subfolder, tileFolder)
+    
+    keptTiles = set()
+    if tileSize > 0:
+        os.makedirs(tilePath, exist_ok = True)
+        tiles = dict()
+        for (name, plane) in planes.items():
+            tiles[name] = []
+            for (x1, y1, x2, y2) in getTileRectangles():
+                tileName = "{0}/{1}_{2}_{3}".format(tileFolder, name, x1 // tileSize, y1 // tileSize)
+                fileHash = writePlane(plane[y1:y2, x1:x2], subfolder, tileName, buildState, report, isMask = name == "mask")
+                tiles[name].append({"x": x1, "y": y1, "width": x2 - x1, "height": y2 - y1, "file": tileName + ".png", "sha256": fileHash})
+                keptTiles.add(os.path.basename(tileName + ".png"))
+                tileFiles.append(tileName + ".png")
+        
+        manifest = {
+            "canvas_size": list(canvasSize),
+            "tile_size": tileSize,
+            "outputs": tiles
+        }
+        writeTextOutput(manifestPath, json.dumps(manifest, indent=4), buildState)
+        tileFiles.append("tiles.json")
+    elif os.path.isfile(manifestPath):
+        os.remove(manifestPath)
+        if buildState is not None:
+            buildState["changed"] = True
+    
+    # tiles of an earlier tile size or canvas size would otherwise linger next to the new ones
+    if os.path.isdir(tilePath):
+        for fileName in os.listdir(tilePath):
+            if fileName.endswith(".png") and not fileName in keptTiles:
+                os.remove(os.path.join(tilePath, fileName))
+                if buildState is not None:
+                    buildState["changed"] = True
+    return tileFiles
 
 def colorDistanceRawEuclidean(color, pixel):
     elementDeltaSquares = [(colorElement - pixelElement) ** 2 for colorElement, pixelElement in zip(color[0:2], pixel[0:2])]
@@ -93,7 +825,69 @@ def colorDistancePerceptualEuclidean(color, pixel):
     weightedDeltaSquares = [deltaElement ** 2 for deltaElement in weightedDelta]
     return math.sqrt(sum(weightedDeltaSquares))
 
+def reportNormalization(fixedPixels, alphaProblems, wrongPixels):
+    if fixedPixels != 0 or alphaProblems != 0:
+        print("\tfixed {0} incorrect pixels and {1} semi-transparent pixels".format(fixedPixels, alphaProblems))
+        maxOops = 0
+        for (original, new, difference) in wrongPixels:
+            maxOops = max(maxOops, difference)
+            print("\t\t{0} -> {1} (delta = {2})".format(original, new, difference))
+        
+        if (maxOops > 5):
+            print("\ttoo broken with max = {0}, excluding from autopick".format(maxOops))
+            return False
+    return True
+
+def packPixels(pixels):
+    # view RGBA bytes as one uint32 per pixel so whole pixels compare in one operation
+    return np.ascontiguousarray(pixels).view(np.uint32).reshape(pixels.shape[:-1])
+
+def nearestPaletteColors(colors):
+    # vectorized colorDistancePerceptualEuclidean, including its R/G-only comparison,
+    # so that ties and deltas come out exactly as the per-pixel loop computes them
+    nearest = np.empty(len(colors), dtype=np.intp)
+    deltas = np.empty(len(colors), dtype=np.float64)
+    for chunkStart in range(0, len(colors), nearestColorChunk):
+        chunk = colors[chunkStart:chunkStart + nearestColorChunk, np.newaxis, 0:2].astype(np.float64)
+        weightedDelta = perceptualWeights[0:2] * (chunk - paletteArray[np.newaxis, :, 0:2])
+        distances = np.sqrt(np.sum(weightedDelta ** 2, axis=2))
+        nearest[chunkStart:chunkStart + len(chunk)] = np.argmin(distances, axis=1)
+        deltas[chunkStart:chunkStart + len(chunk)] = np.min(distances, axis=1)
+    return (nearest, deltas)
+
 def normalizeImage(convertedImage):
+    pixels = np.array(convertedImage)
+    
+    transparent = pixels[..., 3] < 128
+    pixels[transparent] = 0
+    
+    pixelKeys = packPixels(pixels)
+    offPalette = ~transparent & ~np.isin(pixelKeys, paletteKeys)
+    
+    fixedPixels = 0
+    alphaProblems = 0
+    wrongPixels = set()
+    
+    if offPalette.any():
+        # only the distinct off-palette colors need a nearest color lookup
+        (uniqueKeys, inverse, counts) = np.unique(pixelKeys[offPalette], return_inverse=True, return_counts=True)
+        uniqueColors = uniqueKeys.view(np.uint8).reshape(-1, 4)
+        (nearest, deltas) = nearestPaletteColors(uniqueColors)
+        newColors = paletteArray[nearest]
+        
+        alphaOnly = np.all(uniqueColors[:, 0:2] == newColors[:, 0:2], axis=1)
+        alphaProblems = int(counts[alphaOnly].sum())
+        fixedPixels = int(counts[~alphaOnly].sum())
+        for (original, new, difference) in zip(uniqueColors[~alphaOnly].tolist(), newColors[~alphaOnly].tolist(), deltas[~alphaOnly].tolist()):
+            wrongPixels.add((tuple(original), tuple(new), difference))
+        
+        pixels[offPalette] = newColors[inverse.reshape(-1)]
+    
+    convertedImage.frombytes(pixels.tobytes())
+    return reportNormalization(fixedPixels, alphaProblems, wrongPixels)
+
+# reference implementation that normalizeImage must agree with, kept for benchmark.py
+def normalizeImagePerPixel(convertedImage):
     fixedPixels = 0
     alphaProblems = 0
     wrongPixels = set()
@@ -125,63 +919,409 @@ def normalizeImage(convertedImage):
                 wrongPixels.add((pixel, newColor, newDelta))
             convertedImage.putpixel(xy, newColor)
     
-    if fixedPixels != 0 or alphaProblems != 0:
-        print("\tfixed {0} incorrect pixels and {1} semi-transparent pixels".format(fixedPixels, alphaProblems))
-        maxOops = 0
-        for (original, new, difference) in wrongPixels:
-            maxOops = max(maxOops, difference)
-            print("\t\t{0} -> {1} (delta = {2})".format(original, new, difference))
-        
-        if (maxOops > 5):
-            print("\ttoo broken with max = {0}, excluding from autopick".format(maxOops))
-            return False
-    return True
+    return reportNormalization(fixedPixels, alphaProblems, wrongPixels)
 
-def loadTemplateEntryImage(templateEntry, subfolder):
-    # used to erase animations from all shipped images. render a fully opaque mask
-    if "forcewidth" in templateEntry:
-        return createImage((templateEntry["forcewidth"], templateEntry["forceheight"]), isMask = True)
+@contextlib.contextmanager
+def timeEntryStage(templateEntry, stage):
+    # adds up per-entry timings for the build report, entries may be None when nobody is reporting
+    startTime = time.perf_counter()
+    try:
+        yield
+    finally:
+        if templateEntry is not None:
+            timings = templateEntry.setdefault("__timings", dict())
+            timings[stage] = timings.get(stage, 0) + time.perf_counter() - startTime
 
-    for imageSource in templateEntry["images"]:
-        try:
-            if imageSource.startswith("http"):
-                headers = {
-                    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/113.0",
-                    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
-                }
-                request = urllib.request.Request(imageSource, headers = headers, method = "GET")
-                responseObject = urllib.request.urlopen(request, timeout=5)
-                rawImage = Image.open(responseObject)
-            else:
-                rawImage = Image.open(os.path.join(subfolder, imageSource))
-            
-            convertedImage = Image.new("RGBA", (rawImage.width, rawImage.height))
-            convertedImage.paste(rawImage)
+def readTemplateEntrySource(imageSource, subfolder, fetcher, templateEntry = None):
+    with timeEntryStage(templateEntry, "fetch_wait"):
+        if imageSource.startswith("http"):
+            return fetcher.fetch(imageSource)
+        sourcePath = os.path.join(subfolder, imageSource)
+        if os.path.getsize(sourcePath) > sourceLimits["bytes"]:
+            raise ValueError("{0} is over the budget of {1} bytes".format(imageSource, sourceLimits["bytes"]))
+        with open(sourcePath, "rb") as f:
+            return f.read()
+
+def hashTemplateEntrySource(sourceBytes, templateEntry = None):
+    # normalized images are cached by this, so a region of a sprite sheet is not mistaken for the whole sheet
+    sourceHash = hashlib.sha256(sourceBytes)
+    if templateEntry is not None and "__region" in templateEntry:
+        sourceHash.update(json.dumps(templateEntry["__region"]).encode("utf-8"))
+    return sourceHash.hexdigest()
+
+def readSourceHeader(rawImage):
+    return {"format": rawImage.format, "mode": rawImage.mode, "width": rawImage.width, "height": rawImage.height, "frames": getattr(rawImage, "n_frames", 1)}
+
+def peekSourceHeader(partialBytes):
+    # the header of a download that is still going on, None when it can't be told yet or isn't an image
+    try:
+        with Image.open(io.BytesIO(partialBytes)) as rawImage:
+            return readSourceHeader(rawImage)
+    except Image.DecompressionBombError:
+        raise
+    except Exception:
+        return None
 
+def getSourcePixelBudget():
+    return max(sourceLimits["pixels"], canvasSize[0] * canvasSize[1])
+
+def checkSourcePixelBudget(header):
+    if header["width"] * header["height"] > getSourcePixelBudget():
+        raise ValueError("{0}x{1} source is over the budget of {2} pixels".format(header["width"], header["height"], getSourcePixelBudget()))
+
+def isExportGroupEntry(templateEntry):
+    return "export_group" in templateEntry and str(templateEntry["export_group"]) != ""
+
+def isTemplateEntryAutoPick(templateEntry):
+    return "autopick" in templateEntry and bool(templateEntry["autopick"]) and not "__noauto" in templateEntry
+
+def validateTemplateEntrySource(templateEntry, header):
+    # everything the header alone can rule out, before a single pixel is decoded
+    checkSourcePixelBudget(header)
+    if templateEntry is None:
+        return
+    size = (header["width"], header["height"])
+    if "__region" in templateEntry:
+        (x, y, width, height) = templateEntry["__region"]
+        if x < 0 or y < 0 or x + width > header["width"] or y + height > header["height"]:
+            raise ValueError("region {0} is outside the {1}x{2} source".format(templateEntry["__region"], header["width"], header["height"]))
+        size = (width, height)
+    checkTemplateEntryOnCanvas(templateEntry, size)
+
+def getCachedSourceHeader(details):
+    # normalized images cached before headers were recorded only know their own size
+    return details.get("header", {"width": details["width"], "height": details["height"]})
+
+def canDecodeSourceRows(rawImage):
+    # shortening the decode relies on Pillow internals, a single (codec, extents, offset, args) tile over the
+    # whole image and a writable _size. any other Pillow is decoded whole and cropped
+    if rawImage.format != "PNG" or rawImage.info.get("interlace") or len(rawImage.tile) != 1:
+        return False
+    tile = rawImage.tile[0]
+    return hasattr(rawImage, "_size") and len(tile) == 4 and tuple(tile[1]) == (0, 0, rawImage.width, rawImage.height)
+
+def decodeSourceRegion(rawImage, region):
+    # non-interlaced PNGs are decoded top down, so rows below the region are never decoded once the decoder
+    # is told the image ends there. anything else is decoded whole and cropped
+    (x, y, width, height) = region
+    if canDecodeSourceRows(rawImage):
+        tile = rawImage.tile[0]
+        rawImage._size = (rawImage.width, y + height)
+        rawImage.tile = [(tile[0], (0, 0, rawImage.width, y + height)) + tuple(tile[2:])]
+    return rawImage.crop((x, y, x + width, y + height))
+
+def decodeTemplateEntrySource(sourceBytes, contentHash, cache, templateEntry = None):
+    if cache:
+        with timeEntryStage(templateEntry, "cache_load"):
+            cachedImage = cache.loadImage("normalized", contentHash)
+        if cachedImage is not None:
+            (convertedImage, details) = cachedImage
+            # normalized before, maybe for another entry or while the entry was somewhere else
+            validateTemplateEntrySource(templateEntry, getCachedSourceHeader(details))
+            if templateEntry is not None:
+                templateEntry["__header"] = getCachedSourceHeader(details)
+            return (convertedImage, details["clean"])
+    
+    with timeEntryStage(templateEntry, "validate"):
+        rawImage = Image.open(io.BytesIO(sourceBytes))
+        header = readSourceHeader(rawImage)
+        if templateEntry is not None:
+            templateEntry["__header"] = header
+        try:
+            validateTemplateEntrySource(templateEntry, header)
+        except:
             rawImage.close()
+            raise
+    
+    with timeEntryStage(templateEntry, "decode"):
+        if templateEntry is not None and "__region" in templateEntry:
+            regionImage = decodeSourceRegion(rawImage, templateEntry["__region"])
+            rawImage.close()
+            rawImage = regionImage
+        
+        convertedImage = Image.new("RGBA", (rawImage.width, rawImage.height))
+        convertedImage.paste(rawImage)
+        
+        rawImage.close()
+    
+    with timeEntryStage(templateEntry, "normalize"):
+        isClean = normalizeImage(convertedImage)
+    if cache:
+        cache.storeImage("normalized", contentHash, convertedImage, {"clean": isClean, "header": header})
+    return (convertedImage, isClean)
+
+def loadTemplateEntryImage(templateEntry, subfolder, fetcher):
+    # fingerprinting already found the source, so its normalized image is cached
+    if "__source_hash" in templateEntry and fetcher.cache:
+        with timeEntryStage(templateEntry, "cache_load"):
+            cachedImage = fetcher.cache.loadImage("normalized", templateEntry["__source_hash"])
+        if cachedImage is not None:
+            (convertedImage, details) = cachedImage
+            if not details["clean"]:
+                templateEntry["__noauto"] = True
+            templateEntry["__header"] = getCachedSourceHeader(details)
+            return convertedImage
+    
+    for imageSource in templateEntry["images"]:
+        try:
+            sourceBytes = readTemplateEntrySource(imageSource, subfolder, fetcher, templateEntry)
+            contentHash = hashTemplateEntrySource(sourceBytes, templateEntry)
+            (convertedImage, isClean) = decodeTemplateEntrySource(sourceBytes, contentHash, fetcher.cache, templateEntry)
+            fetcher.remember(imageSource, sourceBytes)
             
-            isClean = normalizeImage(convertedImage)
+            templateEntry["__source"] = imageSource
+            templateEntry["__source_hash"] = contentHash
             if not isClean:
                 templateEntry["__noauto"] = True
             
             return convertedImage
         except Exception as e:
             print("Eat exception {0}".format(e))
+            templateEntry.setdefault("__failed_sources", []).append({"source": imageSource, "error": str(e)})
     
     raise RuntimeError("unable to load any images for {0}".format(templateEntry["name"]))
 
-def resolveTemplateFileEntry(templateFileEntry):
+def getEntryMemoryKey(templateEntry):
+    return templateEntry.get("__source_hash")
+
+def loadTemplateEntryPlanes(templateEntry, subfolder, fetcher, memory = None):
+    # an entry's image as palette indices, together with the priority masks generated for it so far
+    memoryKey = getEntryMemoryKey(templateEntry)
+    loadedEntry = memory.recall(memoryKey) if memory is not None and memoryKey else None
+    if loadedEntry is not None:
+        if loadedEntry["noauto"]:
+            templateEntry["__noauto"] = True
+        return loadedEntry
+    
+    with loadTemplateEntryImage(templateEntry, subfolder, fetcher) as image:
+        indices = getPaletteIndices(np.array(image))
+    if indices is None:
+        raise ValueError("{0} has pixels outside the palette after normalizing".format(templateEntry["name"]))
+    return rememberLoadedEntry(templateEntry, indices, fetcher, memory)
+
+def rememberLoadedEntry(templateEntry, indices, fetcher, memory = None):
+    # lets later builds find out whether the entry is covered without decoding it, see planOcclusion
+    if fetcher.cache and "__source_hash" in templateEntry and not fetcher.cache.hasImage("coverage", templateEntry["__source_hash"]):
+        with Image.fromarray(indices != 0) as coverageImage:
+            fetcher.cache.storeImage("coverage", templateEntry["__source_hash"], coverageImage)
+    
+    loadedEntry = {"indices": indices, "noauto": "__noauto" in templateEntry, "masks": dict()}
+    if memory is not None:
+        memory.remember(getEntryMemoryKey(templateEntry), loadedEntry)
+    return loadedEntry
+
+# entries loaded by earlier builds of a watched folder, keyed by the hash of their source. whatever the
+# latest build did not use is forgotten after it
+class EntryMemory:
+    def __init__(self):
+        self.entries = dict()
+        self.used = set()
+    
+    def recall(self, key):
+        if key in self.entries:
+            self.used.add(key)
+        return self.entries.get(key)
+    
+    def remember(self, key, loadedEntry):
+        self.entries[key] = loadedEntry
+        self.used.add(key)
+    
+    def prune(self):
+        self.entries = dict((key, loadedEntry) for (key, loadedEntry) in self.entries.items() if key in self.used)
+        self.used = set()
+
+def prepareTemplateEntry(templateEntry, sourceBytes, settings, size, withImage):
+    # what loadTemplateEntryPlanes and getPriorityValues compute for one source, in an EntryPipeline worker.
+    # the normalized image only comes back when the caller is going to cache it, and what normalizing
+    # prints comes back too so it ends up in draw order
+    global canvasSize
+    applyWorkerSettings(settings)
+    canvasSize = size
+    
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        (convertedImage, isClean) = decodeTemplateEntrySource(sourceBytes, None, None, templateEntry)
+    with convertedImage:
+        indices = getPaletteIndices(np.array(convertedImage))
+        normalizedBytes = convertedImage.tobytes() if withImage else None
+    if indices is None:
+        raise ValueError("{0} has pixels outside the palette after normalizing".format(templateEntry["name"]))
+    
+    if not isClean:
+        templateEntry["__noauto"] = True
+    priorityValues = None
+    if isTemplateEntryAutoPick(templateEntry):
+        with timeEntryStage(templateEntry, "priority_mask"):
+            priorityValues = generatePriorityValues(templateEntry, indices != 0)
+    return {"indices": indices, "clean": isClean, "image": normalizedBytes, "priority_values": priorityValues, "header": templateEntry["__header"], "timings": templateEntry.get("__timings", dict()), "output": output.getvalue()}
+
+def getPipelineWorkers():
+    # daemonic processes, like multiprocessing.Pool workers, can't start a pool of their own
+    if multiprocessing.current_process().daemon:
+        return 1
+    return renderSettings["workers"] or os.cpu_count() or 1
+
+# decodes, normalizes and generates priority masks for the entries ahead of the render loop in worker
+# processes, while the render loop composites in draw order. entries that memory, the cache or an animation
+# already account for are left to the render loop, and at most `window` entries are in flight so finished
+# ones don't pile up. whatever fails in a worker is loaded again by the render loop itself, which tries
+# the entry's other sources and reports the failures as usual
+class EntryPipeline:
+    def __init__(self, templates, subfolder, fetcher, memory = None, workers = 1):
+        self.subfolder = subfolder
+        self.fetcher = fetcher
+        self.memory = memory
+        self.workers = workers
+        self.window = 2 * workers
+        self.upcoming = collections.deque(templates)
+        self.pending = dict()
+        self.pool = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exceptionInfo):
+        self.close()
+    
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait = True, cancel_futures = True)
+            self.pool = None
+    
+    def needsDecoding(self, templateEntry):
+        # reads the source loadTemplateEntryImage would try first, None when there is nothing to decode
+        if "__source_hash" in templateEntry:
+            return None
+        imageSource = templateEntry["images"][0]
+        try:
+            sourceBytes = readTemplateEntrySource(imageSource, self.subfolder, self.fetcher, templateEntry)
+        except Exception:
+            return None
+        contentHash = hashTemplateEntrySource(sourceBytes, templateEntry)
+        if self.memory is not None and self.memory.recall(contentHash) is not None:
+            return None
+        if self.fetcher.cache and self.fetcher.cache.hasImage("normalized", contentHash):
+            return None
+        
+        # sources the header already rules out fail quicker right here
+        header = peekSourceHeader(sourceBytes)
+        if header is None:
+            return None
+        try:
+            validateTemplateEntrySource(templateEntry, header)
+        except Exception:
+            return None
+        return (imageSource, sourceBytes, contentHash)
+    
+    def submitAhead(self):
+        while self.workers > 1 and len(self.pending) < self.window and len(self.upcoming) > 0:
+            templateEntry = self.upcoming.popleft()
+            source = self.needsDecoding(templateEntry)
+            if source is None:
+                continue
+            if self.pool is None:
+                self.pool = concurrent.futures.ProcessPoolExecutor(max_workers = self.workers)
+            workerEntry = dict((key, value) for (key, value) in templateEntry.items() if key != "__timings")
+            prepared = self.pool.submit(prepareTemplateEntry, workerEntry, source[1], getWorkerSettings(), canvasSize, bool(self.fetcher.cache))
+            self.pending[id(templateEntry)] = (source, prepared)
+    
+    def prepare(self, templateEntry):
+        # decodes the entry if nothing has yet, so that fingerprinting finds it in the cache
+        self.submitAhead()
+        if id(templateEntry) in self.pending:
+            self.load(templateEntry)
+    
+    def load(self, templateEntry):
+        # the entry's loaded planes like loadTemplateEntryPlanes, entries have to be loaded in the order
+        # they were passed in
+        self.submitAhead()
+        if not id(templateEntry) in self.pending:
+            return loadTemplateEntryPlanes(templateEntry, self.subfolder, self.fetcher, self.memory)
+        
+        ((imageSource, sourceBytes, contentHash), prepared) = self.pending.pop(id(templateEntry))
+        try:
+            result = prepared.result()
+        except Exception:
+            return loadTemplateEntryPlanes(templateEntry, self.subfolder, self.fetcher, self.memory)
+        
+        print(result["output"], end = "")
+        timings = templateEntry.setdefault("__timings", dict())
+        for (stage, seconds) in result["timings"].items():
+            timings[stage] = timings.get(stage, 0) + seconds
+        templateEntry["__source"] = imageSource
+        templateEntry["__source_hash"] = contentHash
+        templateEntry["__header"] = result["header"]
+        if not result["clean"]:
+            templateEntry["__noauto"] = True
+        
+        indices = result["indices"]
+        if self.fetcher.cache:
+            with Image.frombytes("RGBA", getPlaneSize(indices), result["image"]) as convertedImage:
+                self.fetcher.cache.storeImage("normalized", contentHash, convertedImage, {"clean": result["clean"], "header": result["header"]})
+        self.fetcher.remember(imageSource, sourceBytes)
+        
+        loadedEntry = rememberLoadedEntry(templateEntry, indices, self.fetcher, self.memory)
+        if result["priority_values"] is not None:
+            priority = getMaskPriority(templateEntry)
+            loadedEntry["masks"][priority] = result["priority_values"]
+            storePriorityValues(templateEntry, priority, result["priority_values"], self.fetcher.cache)
+        return loadedEntry
+
+def fingerprintTemplateEntry(templateEntry, subfolder, fetcher):
+    # everything about an entry that can change the published outputs
+    fingerprint = {"x": templateEntry["x"], "y": templateEntry["y"]}
+    for fingerprintProperty in ["priority", "autopick", "export_group", "__region", "__animation"]:
+        if fingerprintProperty in templateEntry:
+            fingerprint[fingerprintProperty] = templateEntry[fingerprintProperty]
+    
+    # the first source that yields an image wins, exactly as in loadTemplateEntryImage, but sources
+    # that were normalized before are recognized by their hash without decoding them again
+    for imageSource in templateEntry["images"]:
+        try:
+            sourceBytes = readTemplateEntrySource(imageSource, subfolder, fetcher, templateEntry)
+            contentHash = hashTemplateEntrySource(sourceBytes, templateEntry)
+            cachedDetails = fetcher.cache.getImageDetails("normalized", contentHash)
+            if cachedDetails is None:
+                decodeTemplateEntrySource(sourceBytes, contentHash, fetcher.cache, templateEntry)[0].close()
+            else:
+                validateTemplateEntrySource(templateEntry, getCachedSourceHeader(cachedDetails))
+            fetcher.remember(imageSource, sourceBytes)
+            
+            templateEntry["__source"] = imageSource
+            templateEntry["__source_hash"] = contentHash
+            fingerprint["source"] = contentHash
+            return fingerprint
+        except Exception as e:
+            print("Eat exception {0}".format(e))
+            templateEntry.setdefault("__failed_sources", []).append({"source": imageSource, "error": str(e)})
+    
+    raise RuntimeError("unable to load any images for {0}".format(templateEntry["name"]))
+
+def fingerprintBuild(templateFile, templates, subfolder, fetcher, utcNow):
+    entryFingerprints = []
+    enabled = [templateEntry for templateEntry in templates if isTemplateEntryEnabled(templateEntry, utcNow)]
+    with EntryPipeline(enabled, subfolder, fetcher, workers = getPipelineWorkers()) as pipeline:
+        for templateEntry in enabled:
+            with timeEntryStage(templateEntry, "fingerprint"):
+                pipeline.prepare(templateEntry)
+                entryFingerprints.append(fingerprintTemplateEntry(templateEntry, subfolder, fetcher))
+    
+    buildInputs = {
+        "canvas": canvasSize,
+        "tile_size": outputSettings["tile_size"],
+        "encoding": getEncodingKey(),
+        "hashed": outputSettings["hashed"],
+        "endu_info": templateFile["endu_info"],
+        "entries": entryFingerprints
+    }
+    return hashlib.sha256(json.dumps(buildInputs, sort_keys = True).encode("utf-8")).hexdigest()
+
+def resolveTemplateFileEntry(templateFileEntry, fetcher):
     requiredProperties = ["name", "x", "y"]
     if "endu" in templateFileEntry:
         try:
-            target = templateFileEntry["endu"]
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/113.0",
-                "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
-            }
-            request = urllib.request.Request(target, headers = headers, method = "GET")
-            responseObject = urllib.request.urlopen(request, timeout=5)
-            enduTemplate = json.loads(responseObject.read().decode("utf-8"))
+            enduBody = fetcher.fetch(templateFileEntry["endu"])
+            enduTemplate = json.loads(enduBody.decode("utf-8"))
             
             output = []
             for enduTemplateEntry in enduTemplate["templates"]:
@@ -199,7 +1339,8 @@ def resolveTemplateFileEntry(templateFileEntry):
                     "name": localName,
                     "images": enduTemplateEntry["sources"],
                     "x": enduTemplateEntry["x"],
-                    "y": enduTemplateEntry["y"]
+                    "y": enduTemplateEntry["y"],
+                    "__endu": templateFileEntry["endu"]
                 }
                 
                 for copyProperty in ["export_group", "autopick", "priority"]:
@@ -211,14 +1352,15 @@ def resolveTemplateFileEntry(templateFileEntry):
                     converted["x"] = abs(converted["x"])
                     converted["y"] = abs(converted["y"])
                 
-                if "frameRate" in enduTemplateEntry:
-                    print("Forcing exclusion of animated template {0}".format(localName))
-                    converted["autopick"] = False
-                    converted["__exclude"] = True
-                    converted["forcewidth"] = enduTemplateEntry["frameWidth"]
-                    converted["forceheight"] = enduTemplateEntry["frameHeight"]
+                if "frameWidth" in enduTemplateEntry and "frameHeight" in enduTemplateEntry:
+                    # a sprite sheet shows one frame at a time, only that part of the sheet is decoded. stills
+                    # show their first frame, animations whichever frame is up, see selectAnimationFrames
+                    converted["__region"] = [0, 0, int(enduTemplateEntry["frameWidth"]), int(enduTemplateEntry["frameHeight"])]
+                    if "frameRate" in enduTemplateEntry or "frameSpeed" in enduTemplateEntry:
+                        converted["__animation"] = getAnimationSettings(enduTemplateEntry)
                 
                 output.append(converted)
+            fetcher.remember(templateFileEntry["endu"], enduBody)
             return output
         except Exception as e:
             print("Failed to load Endu template for {0}: {1}".format(templateFileEntry["name"], e))
@@ -291,14 +1433,72 @@ def isFilledPixelOnEdge(image, knownTransparent, xy):
 def isTransparent(pixelTuple):
     return pixelTuple[3] < 128
 
-def generatePriorityMask(templateEntry, image):
+def getMaskPriority(templateEntry):
     priority = 1
     if "priority" in templateEntry:
         priority = int(templateEntry["priority"])
         if priority < 1 or priority > 10:
             raise ValueError("{0} priority out of acceptable range".format(templateEntry["name"]))
-        
-    priority *= 23
+    
+    return priority * 23
+
+def shiftPlane(plane, dx, dy):
+    # shifted[y, x] == plane[y + dy, x + dx], False where that falls outside the image
+    padded = np.pad(plane, 2)
+    return padded[2 + dy:2 + dy + plane.shape[0], 2 + dx:2 + dx + plane.shape[1]]
+
+def dilatePlane(plane):
+    dilated = plane.copy()
+    for (dx, dy) in getSurroundingPixels((0, 0)):
+        dilated |= shiftPlane(plane, dx, dy)
+    return dilated
+
+def findEdgePixels(opaque):
+    # same classification as the raster scan in generatePriorityMaskPerPixel: a filled pixel is an edge
+    # if it is on the image border or next to a transparent pixel, except that the scan only learns
+    # about a transparent lower-left neighbor from the look-ahead of the pixel two to the left
+    transparent = ~opaque
+    (height, width) = opaque.shape
+    (ys, xs) = np.indices(opaque.shape)
+    
+    border = (xs == 0) | (ys == 0) | (xs == width - 1) | (ys == height - 1)
+    
+    nearTransparent = np.zeros(opaque.shape, dtype=bool)
+    for (dx, dy) in getSurroundingPixels((0, 0)):
+        if (dx, dy) != (-1, 1):
+            nearTransparent |= shiftPlane(transparent, dx, dy)
+    
+    lowerLeftKnown = (xs <= 2) | (ys == 1) | shiftPlane(opaque, -2, 0)
+    nearTransparent |= shiftPlane(transparent, -1, 1) & lowerLeftKnown
+    
+    return opaque & (border | nearTransparent)
+
+def generatePriorityValues(templateEntry, opaque):
+    priority = getMaskPriority(templateEntry)
+    
+    edgePixels = findEdgePixels(opaque)
+    innerPixels = opaque & ~edgePixels
+    
+    # peel rings inwards from the edge, each one a step dimmer
+    maskValues = np.full(opaque.shape, priority, dtype=np.uint8)
+    for iteration in range(0,6):
+        maskValues[edgePixels] = priority + 25 - iteration * 5
+        edgePixels = dilatePlane(edgePixels) & innerPixels
+        innerPixels &= ~edgePixels
+    
+    maskValues[~opaque] = 0
+    return maskValues
+
+def generatePriorityMask(templateEntry, image):
+    opaque = np.array(image.getchannel("A")) >= 128
+    maskValues = generatePriorityValues(templateEntry, opaque)
+    maskAlpha = np.where(opaque, 255, 0).astype(np.uint8)
+    maskPixels = np.dstack([maskValues, maskValues, maskValues, maskAlpha])
+    return Image.frombytes("RGBA", (image.width, image.height), maskPixels.tobytes())
+
+# reference implementation that generatePriorityMask must agree with, kept for benchmark.py
+def generatePriorityMaskPerPixel(templateEntry, image):
+    priority = getMaskPriority(templateEntry)
     mask = Image.new("RGBA", (image.width, image.height), (0, 0, 0, 0))
     maskDraw = ImageDraw.Draw(mask)
     
@@ -343,55 +1543,399 @@ def generatePriorityMask(templateEntry, image):
 
     return mask
 
-def generateTransparencyMask(image):
-    return image.getchannel("A").point(lambda a: 0 if a == 0 else 255)
+def getPriorityValues(templateEntry, loadedEntry, cache):
+    # loaded entries remember their masks per priority, see loadTemplateEntryPlanes
+    priority = getMaskPriority(templateEntry)
+    if priority in loadedEntry["masks"]:
+        return loadedEntry["masks"][priority]
+    
+    opaque = loadedEntry["indices"] != 0
+    maskKey = "{0}_{1}".format(templateEntry.get("__source_hash"), priority)
+    cachedMask = cache.loadImage("masks", maskKey) if cache and "__source_hash" in templateEntry else None
+    if cachedMask is not None:
+        with cachedMask[0]:
+            maskValues = np.array(cachedMask[0].getchannel(0))
+    else:
+        maskValues = generatePriorityValues(templateEntry, opaque)
+        storePriorityValues(templateEntry, priority, maskValues, cache)
+    
+    loadedEntry["masks"][priority] = maskValues
+    return maskValues
 
+def storePriorityValues(templateEntry, priority, maskValues, cache):
+    if cache and "__source_hash" in templateEntry:
+        maskKey = "{0}_{1}".format(templateEntry["__source_hash"], priority)
+        with Image.frombytes("L", getPlaneSize(maskValues), maskValues.tobytes()) as maskImage:
+            cache.storeImage("masks", maskKey, maskImage)
 
-def getEnduGroup(enduGroups, enduTag):
-    if not enduTag in enduGroups:
-        enduImage = createCanvas()
-        enduExtents = dict()
-        enduGroups[enduTag] = (enduImage, enduExtents)
-    return enduGroups[enduTag]
 
-def generateEnduImage(enduImage, enduExtents):
-    if (enduExtents["x2"] > canvasSize[0] or
-        enduExtents["y2"] > canvasSize[1] or
-        enduExtents["x1"] < 0 or
-        enduExtents["y1"] < 0):
-        raise ValueError("endu extents appear to be bigger than canvas??")
+extentsCellSize = 64
+
+def getEntryRectangle(templateEntry, size):
+    return (templateEntry["x"], templateEntry["y"], templateEntry["x"] + size[0], templateEntry["y"] + size[1])
+
+# uniform grid over the canvas that maps each cell to the export groups whose extents touch it, so erasing
+# an entry only visits the groups it can overlap. pixels outside a group's extents are still transparent,
+# so erasing them would not change anything anyway. planOcclusion indexes entry rectangles with it as well
+class ExtentsIndex:
+    def __init__(self, cellSize = extentsCellSize):
+        self.cellSize = cellSize
+        self.cells = dict()
+        self.extents = dict()
+    
+    def getCells(self, rectangle):
+        (x1, y1, x2, y2) = rectangle
+        for cellY in range(y1 // self.cellSize, (y2 - 1) // self.cellSize + 1):
+            for cellX in range(x1 // self.cellSize, (x2 - 1) // self.cellSize + 1):
+                yield (cellX, cellY)
+    
+    def update(self, name, enduExtents):
+        self.extents[name] = enduExtents
+        for cell in self.getCells((enduExtents["x1"], enduExtents["y1"], enduExtents["x2"], enduExtents["y2"])):
+            self.cells.setdefault(cell, set()).add(name)
     
-    return enduImage.crop((enduExtents["x1"], enduExtents["y1"], enduExtents["x2"], enduExtents["y2"]))
+    def findIntersecting(self, rectangle):
+        (x1, y1, x2, y2) = rectangle
+        if x2 <= x1 or y2 <= y1:
+            return []
+        
+        candidates = set()
+        for cell in self.getCells(rectangle):
+            candidates.update(self.cells.get(cell, ()))
+        
+        intersecting = []
+        for name in candidates:
+            enduExtents = self.extents[name]
+            if enduExtents["x1"] < x2 and x1 < enduExtents["x2"] and enduExtents["y1"] < y2 and y1 < enduExtents["y2"]:
+                intersecting.append(name)
+        return intersecting
 
-def updateExtents(templateEntry, image, enduExtents):
+def updateExtents(templateEntry, size, enduExtents):
     if not "x1" in enduExtents:
         enduExtents["x1"] = templateEntry["x"]
         enduExtents["y1"] = templateEntry["y"]
         
-        enduExtents["x2"] = templateEntry["x"] + image.width
-        enduExtents["y2"] = templateEntry["y"] + image.height
+        enduExtents["x2"] = templateEntry["x"] + size[0]
+        enduExtents["y2"] = templateEntry["y"] + size[1]
     else:
         enduExtents["x1"] = min(enduExtents["x1"], templateEntry["x"])
         enduExtents["y1"] = min(enduExtents["y1"], templateEntry["y"])
         
-        enduExtents["x2"] = max(enduExtents["x2"], templateEntry["x"] + image.width)
-        enduExtents["y2"] = max(enduExtents["y2"], templateEntry["y"] + image.height)
+        enduExtents["x2"] = max(enduExtents["x2"], templateEntry["x"] + size[0])
+        enduExtents["y2"] = max(enduExtents["y2"], templateEntry["y"] + size[1])
+
+def addToEnduGroup(enduGroups, enduTag, templateEntry, indices, opaque):
+    # a group's plane only covers its extents and grows with them. the pixels it gains are transparent,
+    # which is what they would be on a full canvas too
+    (enduPlane, enduExtents) = enduGroups.get(enduTag, (None, dict()))
+    previousExtents = dict(enduExtents)
+    updateExtents(templateEntry, getPlaneSize(indices), enduExtents)
+    
+    if enduExtents != previousExtents:
+        grownPlane = createPlane((enduExtents["x2"] - enduExtents["x1"], enduExtents["y2"] - enduExtents["y1"]))
+        if enduPlane is not None:
+            offsetX = previousExtents["x1"] - enduExtents["x1"]
+            offsetY = previousExtents["y1"] - enduExtents["y1"]
+            grownPlane[offsetY:offsetY + enduPlane.shape[0], offsetX:offsetX + enduPlane.shape[1]] = enduPlane
+        enduPlane = grownPlane
+    enduGroups[enduTag] = (enduPlane, enduExtents)
+    
+    paintPlane(enduPlane, (enduExtents["x1"], enduExtents["y1"]), templateEntry, opaque, indices)
+    return enduExtents
+
+def findTemplateEntryCoverage(templateEntry, subfolder, fetcher):
+    # the opaque pixels of the source the entry is going to load as (coverage, source, hash), if they are
+    # known without decoding anything. the source is the one loadTemplateEntryImage would pick: fingerprinting
+    # already found it, or else the first source, which was normalized before and still passes validation
+    if not fetcher.cache:
+        return None
+    
+    imageSource = templateEntry.get("__source")
+    contentHash = templateEntry.get("__source_hash")
+    if contentHash is None:
+        imageSource = templateEntry["images"][0]
+        try:
+            contentHash = hashTemplateEntrySource(readTemplateEntrySource(imageSource, subfolder, fetcher, templateEntry), templateEntry)
+        except Exception:
+            return None
+    
+    details = fetcher.cache.getImageDetails("normalized", contentHash)
+    if details is None or not fetcher.cache.hasImage("coverage", contentHash):
+        return None
+    try:
+        validateTemplateEntrySource(templateEntry, getCachedSourceHeader(details))
+    except Exception:
+        return None
+    
+    cachedCoverage = fetcher.cache.loadImage("coverage", contentHash)
+    if cachedCoverage is None:
+        return None
+    with cachedCoverage[0]:
+        return (np.array(cachedCoverage[0]), imageSource, contentHash)
+
+def getClippedRectangle(templateEntry, size):
+    (x1, y1, x2, y2) = getEntryRectangle(templateEntry, size)
+    return (max(x1, 0), max(y1, 0), min(x2, canvasSize[0]), min(y2, canvasSize[1]))
+
+def isCoveredByLaterEntries(templateEntry, coverage, rectangle, coveredAll, coveredPlain, earlierGroups):
+    (x1, y1, x2, y2) = rectangle
+    opaque = coverage[y1 - templateEntry["y"]:y2 - templateEntry["y"], x1 - templateEntry["x"]:x2 - templateEntry["x"]]
+    if not coveredAll[y1:y2, x1:x2][opaque].all():
+        return False
+    if len(earlierGroups) == 0:
+        return True
+    
+    # where an export group might already have pixels, only an entry outside of export groups erases them again
+    touched = np.zeros(opaque.shape, dtype=bool)
+    for groupExtents in earlierGroups:
+        touched[max(groupExtents["y1"] - y1, 0):max(groupExtents["y2"] - y1, 0), max(groupExtents["x1"] - x1, 0):max(groupExtents["x2"] - x1, 0)] = True
+    return (coveredPlain[y1:y2, x1:x2] | ~touched)[opaque].all()
+
+def planOcclusion(templates, subfolder, fetcher, utcNow):
+    # marks entries __culled when every one of their opaque pixels is painted again by later entries, so
+    # drawing them can't change canvas, autopick or mask. every entry paints all three wherever it is opaque,
+    # so nothing but coverage matters. only coverage known from the cache counts, both for the entries that
+    # could be culled and for the ones covering them, so nothing is decoded here. export group entries are
+    # always drawn as they decide their group's extents, and animated entries as their other frames may show.
+    # animated entries don't cull anything either
+    enabled = [templateEntry for templateEntry in templates if isTemplateEntryEnabled(templateEntry, utcNow)]
+    coverages = [findTemplateEntryCoverage(templateEntry, subfolder, fetcher) for templateEntry in enabled]
+    
+    # groups an entry might erase from, unknown sizes could be anywhere
+    groupIndex = ExtentsIndex()
+    for (entryIndex, templateEntry) in enumerate(enabled):
+        if isExportGroupEntry(templateEntry):
+            if coverages[entryIndex] is None:
+                rectangle = (0, 0, canvasSize[0], canvasSize[1])
+            else:
+                rectangle = getClippedRectangle(templateEntry, getPlaneSize(coverages[entryIndex][0]))
+            groupIndex.update(entryIndex, {"x1": rectangle[0], "y1": rectangle[1], "x2": rectangle[2], "y2": rectangle[3]})
+    
+    coveredAll = np.zeros((canvasSize[1], canvasSize[0]), dtype=bool)
+    coveredPlain = np.zeros((canvasSize[1], canvasSize[0]), dtype=bool)
+    laterIndex = ExtentsIndex()
+    culled = []
+    for entryIndex in reversed(range(0, len(enabled))):
+        if coverages[entryIndex] is None:
+            continue
+        templateEntry = enabled[entryIndex]
+        (coverage, imageSource, contentHash) = coverages[entryIndex]
+        rectangle = getClippedRectangle(templateEntry, getPlaneSize(coverage))
+        isOnCanvas = rectangle[0] < rectangle[2] and rectangle[1] < rectangle[3]
+        
+        if not isExportGroupEntry(templateEntry) and not isTemplateEntryAnimated(templateEntry):
+            earlierGroups = [groupIndex.extents[groupEntryIndex] for groupEntryIndex in groupIndex.findIntersecting(rectangle) if groupEntryIndex < entryIndex]
+            if not isOnCanvas or (len(laterIndex.findIntersecting(rectangle)) > 0 and isCoveredByLaterEntries(templateEntry, coverage, rectangle, coveredAll, coveredPlain, earlierGroups)):
+                templateEntry["__culled"] = True
+                templateEntry["__source"] = imageSource
+                templateEntry["__source_hash"] = contentHash
+                culled.append(templateEntry)
+                continue
+        
+        # the other frames of an animation may not cover what its active frame does, and its patches are
+        # composited on what is drawn below it
+        if not isOnCanvas or isTemplateEntryAnimated(templateEntry):
+            continue
+        (x1, y1, x2, y2) = rectangle
+        opaque = coverage[y1 - templateEntry["y"]:y2 - templateEntry["y"], x1 - templateEntry["x"]:x2 - templateEntry["x"]]
+        coveredAll[y1:y2, x1:x2] |= opaque
+        if not isExportGroupEntry(templateEntry):
+            coveredPlain[y1:y2, x1:x2] |= opaque
+        laterIndex.update(entryIndex, {"x1": x1, "y1": y1, "x2": x2, "y2": y2})
+    return culled
+
+animationFolder = "animations"
+
+def getAnimationSettings(enduTemplateEntry):
+    # read the way Endu clients read them: frameRate (or frameSpeed) is seconds per frame, frameCount defaults
+    # to a single frame, and animations loop unless looping says otherwise
+    frameSeconds = float(enduTemplateEntry.get("frameRate", enduTemplateEntry.get("frameSpeed", 0)) or 0)
+    frameCount = max(1, int(enduTemplateEntry.get("frameCount", 1)))
+    return {
+        "frame_width": int(enduTemplateEntry["frameWidth"]),
+        "frame_height": int(enduTemplateEntry["frameHeight"]),
+        "frame_count": frameCount,
+        "frame_seconds": frameSeconds if frameSeconds > 0 else None,
+        "start_utc": float(enduTemplateEntry.get("startTime", 0) or 0),
+        "looping": bool(enduTemplateEntry.get("looping", frameCount > 1))
+    }
+
+def isTemplateEntryAnimated(templateEntry):
+    return "__animation" in templateEntry and templateEntry["__animation"]["frame_count"] > 1 and templateEntry["__animation"]["frame_seconds"] is not None
+
+def getAnimationFrame(animation, utcNow):
+    # frames advance every frame_seconds from start_utc on and wrap around when looping, otherwise the last
+    # frame stays. before start_utc the first frame shows
+    if animation["frame_seconds"] is None or utcNow < animation["start_utc"]:
+        return 0
+    frame = int((utcNow - animation["start_utc"]) // animation["frame_seconds"])
+    if animation["looping"]:
+        return frame % animation["frame_count"]
+    return min(frame, animation["frame_count"] - 1)
+
+def getFrameRegion(animation, frame, sheetWidth):
+    # frames are laid out left to right, then row by row
+    framesPerRow = max(1, sheetWidth // animation["frame_width"])
+    return [(frame % framesPerRow) * animation["frame_width"], (frame // framesPerRow) * animation["frame_height"], animation["frame_width"], animation["frame_height"]]
 
-def writeEnduInfos(enduGroups, enduInfo, subfolder):
+def selectAnimationFrames(templates, subfolder, fetcher, utcNow):
+    # points the __region of every animated entry at the frame showing at utcNow, before anything is fingerprinted
+    # or decoded. where a frame sits depends on the sheet's width, which its header tells
+    for templateEntry in templates:
+        if not isTemplateEntryAnimated(templateEntry) or not isTemplateEntryEnabled(templateEntry, utcNow):
+            continue
+        animation = templateEntry["__animation"]
+        animation["active_frame"] = getAnimationFrame(animation, utcNow)
+        if animation["active_frame"] == 0:
+            continue
+        
+        for imageSource in templateEntry["images"]:
+            try:
+                sourceBytes = readTemplateEntrySource(imageSource, subfolder, fetcher)
+                with Image.open(io.BytesIO(sourceBytes)) as rawImage:
+                    sheetWidth = rawImage.width
+            except Exception:
+                # loading the entry tries the same sources and reports what is wrong with them
+                continue
+            templateEntry["__region"] = getFrameRegion(animation, animation["active_frame"], sheetWidth)
+            break
+
+def loadAnimation(templateEntry, subfolder, fetcher, planes):
+    # every frame of the sheet the entry was drawn from as palette indices, normalized once as a whole, along
+    # with what the outputs hold under the entry before it is drawn. later entries mark what they cover
+    animation = templateEntry["__animation"]
+    sourceBytes = readTemplateEntrySource(templateEntry.get("__source", templateEntry["images"][0]), subfolder, fetcher)
+    (sheetImage, isClean) = decodeTemplateEntrySource(sourceBytes, hashTemplateEntrySource(sourceBytes), fetcher.cache)
+    with sheetImage:
+        sheet = getPaletteIndices(np.array(sheetImage))
+    if not isClean:
+        # the same as for an entry whose own image had to be fixed, no frame is autopicked
+        templateEntry["__noauto"] = True
+    
+    frames = []
+    for frame in range(0, animation["frame_count"]):
+        (x, y, width, height) = getFrameRegion(animation, frame, getPlaneSize(sheet)[0])
+        if x + width > sheet.shape[1] or y + height > sheet.shape[0]:
+            raise ValueError("frame {0} is outside the {1}x{2} sheet".format(frame, sheet.shape[1], sheet.shape[0]))
+        frames.append(sheet[y:y + height, x:x + width])
+    
+    rectangle = (templateEntry["x"], templateEntry["y"], templateEntry["x"] + animation["frame_width"], templateEntry["y"] + animation["frame_height"])
+    return {
+        "entry": templateEntry,
+        "frames": frames,
+        "rectangle": rectangle,
+        "below": dict((name, plane[rectangle[1]:rectangle[3], rectangle[0]:rectangle[2]].copy()) for (name, plane) in planes.items()),
+        "covered": np.zeros((animation["frame_height"], animation["frame_width"]), dtype=bool)
+    }
+
+def findDirtyRectangle(previousPlanes, planes):
+    # the smallest rectangle holding every pixel that differs in any of the planes, None if none does
+    changed = np.zeros(planes["canvas"].shape, dtype=bool)
+    for name in planes:
+        changed |= previousPlanes[name] != planes[name]
+    rows = np.flatnonzero(changed.any(axis=1))
+    if len(rows) == 0:
+        return None
+    columns = np.flatnonzero(changed.any(axis=0))
+    return (int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1)
+
+def writeAnimations(animations, planes, subfolder, buildState = None, report = None):
+    # animations.json lists every animated entry with its timing and, for each frame, the rectangle of canvas,
+    # autopick and mask that changes when the frame before it is replaced by it, with patches of those pixels.
+    # frames are composited exactly like the active one, on what lies below the entry and under what later
+    # entries cover. the outputs show the active frame, clients apply the following frames' patches as they
+    # come up. returns the files written
+    animationFiles = []
+    keptPatches = set()
+    schedule = []
+    if len(animations) > 0:
+        os.makedirs(os.path.join(subfolder, animationFolder), exist_ok = True)
+    for (animationIndex, animation) in enumerate(animations):
+        templateEntry = animation["entry"]
+        (x1, y1, x2, y2) = animation["rectangle"]
+        covered = animation["covered"]
+        isAutoPick = isTemplateEntryAutoPick(templateEntry)
+        
+        framePlanes = []
+        for frameIndices in animation["frames"]:
+            opaque = frameIndices != 0
+            framePlane = dict((name, below.copy()) for (name, below) in animation["below"].items())
+            paintOutputs(framePlane, (x1, y1), templateEntry, frameIndices, opaque, generatePriorityValues(templateEntry, opaque) if isAutoPick else None)
+            for (name, plane) in framePlane.items():
+                plane[covered] = planes[name][y1:y2, x1:x2][covered]
+            framePlanes.append(framePlane)
+        
+        settings = templateEntry["__animation"]
+        frames = []
+        for (frame, framePlane) in enumerate(framePlanes):
+            # the first frame only follows the last one when looping
+            dirtyRectangle = None
+            if frame > 0 or settings["looping"]:
+                dirtyRectangle = findDirtyRectangle(framePlanes[frame - 1], framePlane)
+            if dirtyRectangle is None:
+                frames.append(None)
+                continue
+            
+            (dx1, dy1, dx2, dy2) = dirtyRectangle
+            patch = {"x": x1 + dx1, "y": y1 + dy1, "width": dx2 - dx1, "height": dy2 - dy1}
+            for (name, plane) in framePlane.items():
+                patchName = "{0}/{1}_{2}_{3}".format(animationFolder, animationIndex, frame, name)
+                writePlane(plane[dy1:dy2, dx1:dx2], subfolder, patchName, buildState, report, isMask = name == "mask")
+                patch[name] = patchName + ".png"
+                animationFiles.append(patchName + ".png")
+                keptPatches.add(os.path.basename(patchName + ".png"))
+            frames.append(patch)
+        
+        print("\tanimation {0}: frame {1} of {2} showing, {3} patches".format(templateEntry["name"], settings["active_frame"] + 1, len(frames), sum(1 for patch in frames if patch is not None)))
+        schedule.append({
+            "name": templateEntry["name"],
+            "x": x1,
+            "y": y1,
+            "width": x2 - x1,
+            "height": y2 - y1,
+            "frame_seconds": settings["frame_seconds"],
+            "start_utc": settings["start_utc"],
+            "looping": settings["looping"],
+            "active_frame": settings["active_frame"],
+            "frames": frames
+        })
+    
+    schedulePath = os.path.join(subfolder, "animations.json")
+    if len(schedule) > 0:
+        writeTextOutput(schedulePath, json.dumps({"canvas_size": list(canvasSize), "animations": schedule}, indent=4), buildState)
+        animationFiles.append("animations.json")
+    elif os.path.isfile(schedulePath):
+        os.remove(schedulePath)
+        if buildState is not None:
+            buildState["changed"] = True
+    
+    patchPath = os.path.join(subfolder, animationFolder)
+    if os.path.isdir(patchPath):
+        for fileName in os.listdir(patchPath):
+            if fileName.endswith(".png") and not fileName in keptPatches:
+                os.remove(os.path.join(patchPath, fileName))
+                if buildState is not None:
+                    buildState["changed"] = True
+    return animationFiles
+
+def writeEnduInfos(enduGroups, enduInfo, subfolder, buildState = None, report = None):
+    # returns the files written
     outputObject = {
         "faction": enduInfo["name"],
         "contact": enduInfo["contact"],
         "templates": []
     }
+    if outputSettings["hashed"]:
+        outputObject["manifest"] = enduInfo["source_root"] + "manifest.json"
+    enduFiles = []
     
     # groups are in reverse order due to how we render
-    for (groupName, (enduImage, enduExtents)) in reversed(enduGroups.items()):
+    for (groupName, (enduPlane, enduExtents)) in reversed(enduGroups.items()):
         escapedName = urllib.parse.quote_plus(groupName)
         imageName = "endu_" + escapedName
         
-        with generateEnduImage(enduImage, enduExtents) as enduCrop:
-            writeCanvas(enduCrop, subfolder, imageName)
-        enduImage.close()
+        fileHash = writePlane(enduPlane, subfolder, imageName, buildState, report)
+        enduFiles.append(imageName + ".png")
         
         groupInfo = {
             "name": enduInfo["name"] + " - " + groupName,
@@ -401,11 +1945,15 @@ def writeEnduInfos(enduGroups, enduInfo, subfolder):
             "x": enduExtents["x1"],
             "y": enduExtents["y1"]
         }
+        if outputSettings["hashed"]:
+            # the copy that never changes comes first, the plain name is the fallback
+            groupInfo["sources"].insert(0, enduInfo["source_root"] + getPublishedName(imageName + ".png", fileHash))
         
         outputObject["templates"].append(groupInfo)
     
-    with open(os.path.join(subfolder, "endu_template.json"), "w", encoding="utf-8") as f:
-        f.write(json.dumps(outputObject, indent=4))
+    writeTextOutput(os.path.join(subfolder, "endu_template.json"), json.dumps(outputObject, indent=4), buildState)
+    enduFiles.append("endu_template.json")
+    return enduFiles
 
 
 def updateVersion(subfolder):
@@ -420,16 +1968,338 @@ def updateVersion(subfolder):
     
     with open(filePath, "w", encoding="utf-8") as versionFile:
         versionFile.write(str(templateVersion))
+    return templateVersion
 
 
-def loadAllianceTemplatesFromCsv(csvLink, selfSourceRoot):
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/113.0",
-        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
+deltaFolder = "deltas"
+deltaMagic = b"TDLT"
+deltaFormatVersion = 1
+# changed pixels this close together on a row share a run, a run header costs as much as two pixels
+deltaRunGap = 2
+
+def readOutputPlanes(subfolder):
+    # the published canvas and autopick as palette indices and the mask as priorities, None if they
+    # are missing or do not fit that form
+    planes = dict()
+    outputPalette = getOutputPalette()
+    for (name, isMask) in [("canvas", False), ("autopick", False), ("mask", True)]:
+        try:
+            with Image.open(os.path.join(subfolder, name + ".png")) as outputImage:
+                # outputs written by convertPlaneToImage already are planes, anything else goes through RGBA
+                if outputImage.mode == "P" and not isMask and outputImage.info.get("transparency") == 0 and outputImage.getpalette()[0:len(outputPalette)] == outputPalette:
+                    planes[name] = np.array(outputImage)
+                    if planes[name].max() > len(palette):
+                        return None
+                    continue
+                if outputImage.mode == "LA" and isMask:
+                    pixels = np.array(outputImage)
+                    if not np.all(pixels[..., 1] == 255):
+                        return None
+                    planes[name] = np.ascontiguousarray(pixels[..., 0])
+                    continue
+                with outputImage.convert("RGBA") as rgbaImage:
+                    pixels = np.array(rgbaImage)
+        except (OSError, ValueError):
+            return None
+        
+        if isMask:
+            if not (np.all(pixels[..., 3] == 255) and np.array_equal(pixels[..., 0], pixels[..., 1]) and np.array_equal(pixels[..., 0], pixels[..., 2])):
+                return None
+            planes[name] = np.ascontiguousarray(pixels[..., 0])
+        else:
+            planes[name] = getPaletteIndices(pixels)
+            if planes[name] is None:
+                return None
+    return planes
+
+def findDeltaRuns(previousPlanes, planes):
+    changed = np.zeros(planes["canvas"].shape, dtype=bool)
+    for name in planes:
+        changed |= previousPlanes[name] != planes[name]
+    
+    runs = []
+    for y in np.flatnonzero(changed.any(axis=1)):
+        columns = np.flatnonzero(changed[y])
+        splits = np.flatnonzero(np.diff(columns) > deltaRunGap + 1)
+        starts = np.concatenate(([columns[0]], columns[splits + 1]))
+        ends = np.concatenate((columns[splits], [columns[-1]]))
+        for (start, end) in zip(starts, ends):
+            runs.append((int(start), int(y), int(end - start + 1)))
+    return runs
+
+def encodeDelta(previousVersion, version, planes, runs):
+    # header, then a table of (x, y, length) runs, then every run's canvas indices, autopick indices and mask
+    # priorities, one plane after the other. all little endian, zlib compressed as a whole
+    (height, width) = planes["canvas"].shape
+    chunks = [deltaMagic, struct.pack("<BIIHHI", deltaFormatVersion, previousVersion, version, width, height, len(runs))]
+    chunks.append(np.array(runs, dtype="<u2").reshape(-1).tobytes())
+    for name in ["canvas", "autopick", "mask"]:
+        for (x, y, length) in runs:
+            chunks.append(planes[name][y, x:x + length].tobytes())
+    return zlib.compress(b"".join(chunks), 9)
+
+def loadDeltaManifest(subfolder):
+    try:
+        with open(os.path.join(subfolder, "deltas.json"), "r", encoding="utf-8") as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+def writeDeltas(subfolder, previousPlanes, planes, version, utcNow, report = None):
+    # chains a delta from the previous version onto deltas.json. clients more than the chain behind, or
+    # whose deltas would add up to more than the full images, should download the full images instead
+    manifest = loadDeltaManifest(subfolder)
+    deltas = []
+    if manifest is not None and manifest["version"] == version - 1:
+        deltas = manifest["deltas"]
+    
+    if previousPlanes is None or planes["canvas"].shape != previousPlanes["canvas"].shape:
+        print("\tno delta from version {0}, restarting the chain".format(version - 1))
+        deltas = []
+    else:
+        startTime = time.perf_counter()
+        runs = findDeltaRuns(previousPlanes, planes)
+        deltaBytes = encodeDelta(version - 1, version, planes, runs)
+        
+        os.makedirs(os.path.join(subfolder, deltaFolder), exist_ok = True)
+        deltaFile = "{0}/{1}.bin".format(deltaFolder, version)
+        with open(os.path.join(subfolder, deltaFile), "wb") as f:
+            f.write(deltaBytes)
+        
+        deltas.append({"from": version - 1, "to": version, "file": deltaFile, "bytes": len(deltaBytes), "utc": utcNow})
+        changedPixels = sum(run[2] for run in runs)
+        print("\tdelta {0} -> {1}: {2} runs, {3} pixels, {4} bytes".format(version - 1, version, len(runs), changedPixels, len(deltaBytes)))
+        if report is not None:
+            report.delta = {"runs": len(runs), "pixels": changedPixels, "bytes": len(deltaBytes), "seconds": time.perf_counter() - startTime}
+    
+    # the oldest deltas go first once the chain gets too long or too old
+    while len(deltas) > 0 and (sum(delta["bytes"] for delta in deltas) > outputSettings["delta_max_bytes"] or utcNow - deltas[0]["utc"] > outputSettings["delta_max_age"]):
+        deltas.pop(0)
+    
+    fullBytes = sum(os.path.getsize(os.path.join(subfolder, name + ".png")) for name in ["canvas", "autopick", "mask"] if os.path.isfile(os.path.join(subfolder, name + ".png")))
+    manifest = {
+        "version": version,
+        "format": deltaFormatVersion,
+        "palette": paletteArray[:, 0:3].tolist(),
+        "full_bytes": fullBytes,
+        "deltas": deltas
     }
-    request = urllib.request.Request(csvLink, headers = headers, method = "GET")
-    responseObject = urllib.request.urlopen(request, timeout=5)
-    csvText = responseObject.read().decode("utf-8")
+    with open(os.path.join(subfolder, "deltas.json"), "w", encoding="utf-8") as f:
+        f.write(json.dumps(manifest, indent=4))
+    
+    keptDeltas = set(os.path.basename(delta["file"]) for delta in deltas)
+    deltaPath = os.path.join(subfolder, deltaFolder)
+    if os.path.isdir(deltaPath):
+        for fileName in os.listdir(deltaPath):
+            if fileName.endswith(".bin") and not fileName in keptDeltas:
+                os.remove(os.path.join(deltaPath, fileName))
+
+
+publishedFolder = "published"
+# files that the current manifest no longer points to are kept this long for clients still reading an older one
+publishedKeepSeconds = 24 * 3600
+
+def getPublishedName(fileName, fileHash):
+    # e.g. published/tiles/canvas_0_1.0123456789abcdef.png for tiles/canvas_0_1.png, from the sha256 of its contents
+    (stem, extension) = os.path.splitext(fileName)
+    return "{0}/{1}.{2}{3}".format(publishedFolder, stem, fileHash[0:16], extension)
+
+def publishOutputs(subfolder, outputFiles):
+    # copies every output to its content hashed name, unless a copy is already there, then points manifest.json
+    # at them. the manifest is replaced last and in one go, so whoever reads it finds a complete set of files
+    # that never change; uploads only need the new files in published/, and manifest.json last
+    files = dict()
+    newFiles = 0
+    newBytes = 0
+    for fileName in outputFiles:
+        with open(os.path.join(subfolder, fileName), "rb") as f:
+            fileBytes = f.read()
+        fileHash = hashlib.sha256(fileBytes).hexdigest()
+        publishedName = getPublishedName(fileName, fileHash)
+        publishedPath = os.path.join(subfolder, publishedName)
+        if os.path.isfile(publishedPath):
+            # pruning counts from the last build that published a file
+            os.utime(publishedPath)
+        else:
+            os.makedirs(os.path.dirname(publishedPath), exist_ok = True)
+            temporaryPath = "{0}.{1}.tmp".format(publishedPath, os.getpid())
+            with open(temporaryPath, "wb") as f:
+                f.write(fileBytes)
+            os.replace(temporaryPath, publishedPath)
+            newFiles += 1
+            newBytes += len(fileBytes)
+        files[fileName] = {"file": publishedName, "sha256": fileHash, "bytes": len(fileBytes)}
+    
+    version = readVersion(subfolder)
+    manifest = {
+        "version": int(version) if version.isdigit() else 0,
+        "canvas_size": list(canvasSize),
+        "files": files
+    }
+    manifestText = json.dumps(manifest, indent=4)
+    manifestPath = os.path.join(subfolder, "manifest.json")
+    previousText = None
+    if os.path.isfile(manifestPath):
+        with open(manifestPath, "r", encoding="utf-8") as f:
+            previousText = f.read()
+    if previousText != manifestText:
+        temporaryPath = "{0}.{1}.tmp".format(manifestPath, os.getpid())
+        with open(temporaryPath, "w", encoding="utf-8") as f:
+            f.write(manifestText)
+        os.replace(temporaryPath, manifestPath)
+    print("\tpublished {0} of {1} files as new ({2} bytes)".format(newFiles, len(files), newBytes))
+    
+    keptFiles = set(os.path.normpath(os.path.join(subfolder, publishedFile["file"])) for publishedFile in files.values())
+    for (folderPath, folderNames, fileNames) in os.walk(os.path.join(subfolder, publishedFolder)):
+        for fileName in fileNames:
+            filePath = os.path.normpath(os.path.join(folderPath, fileName))
+            if not filePath in keptFiles and time.time() - os.path.getmtime(filePath) > publishedKeepSeconds:
+                os.remove(filePath)
+
+def unpublishOutputs(subfolder):
+    # building without --hashed-outputs removes them, like tiles
+    if os.path.isfile(os.path.join(subfolder, "manifest.json")):
+        os.remove(os.path.join(subfolder, "manifest.json"))
+    shutil.rmtree(os.path.join(subfolder, publishedFolder), ignore_errors = True)
+
+workQueueFile = "work_queue.bin"
+workQueueMagic = b"TWRK"
+workQueueFormatVersion = 1
+# fixed size records, uncompressed, so a bot can read just the first n of them with a range request
+workQueueRecord = np.dtype([("x", "<u2"), ("y", "<u2"), ("index", "u1"), ("priority", "u1")])
+pngSignature = b"\x89PNG\r\n\x1a\n"
+
+def findSnapshotIndices(snapshotImage):
+    # the board as palette indices like getPaletteIndices, except that pixels which are not exactly a palette
+    # color come out as 0 instead of failing the whole snapshot; they never match autopick, so they get fixed
+    with snapshotImage.convert("RGBA") as rgbaImage:
+        pixels = np.array(rgbaImage)
+    
+    paletteOrder = np.argsort(paletteKeys)
+    sortedKeys = paletteKeys[paletteOrder]
+    pixelKeys = packPixels(pixels)
+    positions = np.minimum(np.searchsorted(sortedKeys, pixelKeys), len(sortedKeys) - 1)
+    return np.where(sortedKeys[positions] == pixelKeys, paletteOrder[positions] + 1, 0).astype(np.uint8)
+
+def readSnapshotStream(stream):
+    # yields the PNGs written one after another to a stream, split on their IEND chunks so a snapshot is
+    # handled as soon as it is complete
+    while True:
+        signature = stream.read(len(pngSignature))
+        if len(signature) == 0:
+            return
+        if signature != pngSignature:
+            raise ValueError("snapshot stream is not a sequence of PNGs")
+        
+        chunks = [signature]
+        while True:
+            chunkHeader = stream.read(8)
+            if len(chunkHeader) != 8:
+                raise ValueError("snapshot stream ended in the middle of a PNG")
+            (length, chunkType) = struct.unpack(">I4s", chunkHeader)
+            chunkBody = stream.read(length + 4)
+            if len(chunkBody) != length + 4:
+                raise ValueError("snapshot stream ended in the middle of a PNG")
+            chunks += [chunkHeader, chunkBody]
+            if chunkType == b"IEND":
+                break
+        yield b"".join(chunks)
+
+# the autopick pixels that the board gets wrong, brightest mask priority first, as written to work_queue.bin.
+# every autopick pixel is put in queue order once, so a new snapshot only compares the pixels that changed
+# since the last one and the queue is gathered from that order without sorting again
+class WorkQueue:
+    def __init__(self, subfolder):
+        planes = readOutputPlanes(subfolder)
+        if planes is None:
+            raise ValueError("{0} has no paletted autopick.png and mask.png, build it first".format(subfolder))
+        
+        self.subfolder = subfolder
+        self.version = readVersion(subfolder)
+        self.size = getPlaneSize(planes["autopick"])
+        self.autopick = planes["autopick"].reshape(-1)
+        self.priority = planes["mask"].reshape(-1)
+        # stable, so pixels of the same priority stay in row order
+        targets = np.flatnonzero(self.autopick)
+        self.order = targets[np.argsort(255 - self.priority[targets], kind = "stable")]
+        
+        self.board = None
+        self.wrong = np.zeros(self.autopick.shape, dtype=bool)
+        self.revision = 0
+    
+    def update(self, board):
+        # returns how many pixels of the board changed and whether that changed the queue
+        if getPlaneSize(board) != self.size:
+            raise ValueError("snapshot is {0}x{1}, the canvas is {2}x{3}".format(board.shape[1], board.shape[0], self.size[0], self.size[1]))
+        board = board.reshape(-1)
+        
+        if self.board is None:
+            changed = np.arange(board.size)
+        else:
+            changed = np.flatnonzero(board != self.board)
+        wrong = (self.autopick[changed] != 0) & (board[changed] != self.autopick[changed])
+        queueChanged = self.board is None or bool(np.any(wrong != self.wrong[changed]))
+        self.wrong[changed] = wrong
+        self.board = board
+        return (len(changed), queueChanged)
+    
+    def getRecords(self):
+        queued = self.order[self.wrong[self.order]]
+        records = np.empty(len(queued), dtype=workQueueRecord)
+        records["x"] = queued % self.size[0]
+        records["y"] = queued // self.size[0]
+        records["index"] = self.autopick[queued]
+        records["priority"] = self.priority[queued]
+        return records
+    
+    def write(self):
+        # header, then the records. replaced in one go, so bots never read half a queue
+        self.revision += 1
+        records = self.getRecords()
+        version = int(self.version) if self.version.isdigit() else 0
+        header = workQueueMagic + struct.pack("<BIIHHI", workQueueFormatVersion, version, self.revision, self.size[0], self.size[1], len(records))
+        
+        filePath = os.path.join(self.subfolder, workQueueFile)
+        temporaryPath = "{0}.{1}.tmp".format(filePath, os.getpid())
+        with open(temporaryPath, "wb") as f:
+            f.write(header)
+            f.write(records.tobytes())
+        os.replace(temporaryPath, filePath)
+        return records
+
+def workQueueMain(subfolder, snapshotPath):
+    # writes the work queue for one snapshot, or with "-" for every snapshot read from stdin. a rebuild of
+    # the folder in between is picked up by its version.txt, which resorts the queue against the new outputs
+    if snapshotPath == "-":
+        snapshots = readSnapshotStream(sys.stdin.buffer)
+    else:
+        with open(snapshotPath, "rb") as f:
+            snapshots = [f.read()]
+    
+    workQueue = WorkQueue(subfolder)
+    for snapshotBytes in snapshots:
+        startTime = time.perf_counter()
+        if readVersion(subfolder) != workQueue.version:
+            print("{0} was rebuilt, sorting the queue again".format(subfolder))
+            workQueue = WorkQueue(subfolder)
+        
+        with Image.open(io.BytesIO(snapshotBytes)) as snapshotImage:
+            board = findSnapshotIndices(snapshotImage)
+        (changedPixels, queueChanged) = workQueue.update(board)
+        if not queueChanged:
+            print("work queue: {0} pixels changed, queue unchanged ({1:.3f}s)".format(changedPixels, time.perf_counter() - startTime), flush = True)
+            continue
+        
+        records = workQueue.write()
+        print("work queue: {0} of {1} autopick pixels wrong, {2} pixels changed, revision {3} ({4:.3f}s)".format(
+            len(records), len(workQueue.order), changedPixels, workQueue.revision, time.perf_counter() - startTime), flush = True)
+    return 0
+
+
+def loadAllianceTemplatesFromCsv(csvLink, selfSourceRoot, fetcher):
+    csvBody = fetcher.fetch(csvLink)
+    csvText = csvBody.decode("utf-8")
+    fetcher.remember(csvLink, csvBody)
     
     outputTemplates = []
     for line in csvText.split("\n"):
@@ -457,79 +2327,708 @@ def loadAllianceTemplatesFromCsv(csvLink, selfSourceRoot):
         outputTemplates.append(outputTemplate)
     return outputTemplates
 
-def getTemplates(templateFile):
+def getTemplates(templateFile, fetcher):
     selfSourceRoot = templateFile["endu_info"]["source_root"]
     
     # these are in layer order, so higher entries overwrite/take precedence over lower entries
     inputTemplates = templateFile["templates"]
     if "alliance_csv_import" in templateFile:
-        inputTemplates.extend(loadAllianceTemplatesFromCsv(templateFile["alliance_csv_import"], selfSourceRoot))
+        inputTemplates.extend(loadAllianceTemplatesFromCsv(templateFile["alliance_csv_import"], selfSourceRoot, fetcher))
+    
+    # download every referenced Endu template at once, resolving below still happens in order
+    fetcher.prefetch([templateFileEntry["endu"] for templateFileEntry in inputTemplates if "endu" in templateFileEntry])
     
     # these will be in draw order, so later entries will overwrite earlier entries
     templates = []
     for templateFileEntry in reversed(inputTemplates):
         # endu templates can have multiple entries in them, and they are listed in draw order
-        templates.extend(resolveTemplateFileEntry(templateFileEntry))
+        templates.extend(resolveTemplateFileEntry(templateFileEntry, fetcher))
     return templates
 
-def main(subfolder):
-    templateFile = loadTemplate(subfolder)
-    templates = getTemplates(templateFile)
+def isTemplateEntryEnabled(templateEntry, utcNow):
+    return not ("enabled_utc" in templateEntry and int(templateEntry["enabled_utc"]) > utcNow)
+
+def prefetchTemplateImages(templates, fetcher, utcNow):
+    # only the first remote source of each entry, later sources are fallbacks fetched on demand
+    imageSources = []
+    for templateEntry in templates:
+        if not isTemplateEntryEnabled(templateEntry, utcNow):
+            continue
+        for imageSource in templateEntry["images"]:
+            if imageSource.startswith("http"):
+                imageSources.append(imageSource)
+                break
+    fetcher.prefetch(imageSources)
+
+reportEntryStages = ["fetch_wait", "cache_load", "validate", "decode", "normalize", "priority_mask", "animate", "composite"]
+# what a culled entry doesn't spend, it still has to be fetched to know its source is unchanged
+culledEntryStages = ["cache_load", "validate", "decode", "normalize", "priority_mask", "composite"]
+slowestEntryCount = 5
+
+def getPeakRssMegabytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak / (1048576 if sys.platform == "darwin" else 1024)
+
+# timings for one build, written as build_report.json next to version.txt. whole-build stages are timed
+# here, per-entry stages are collected on the entries themselves by timeEntryStage
+class BuildReport:
+    def __init__(self):
+        self.startTime = time.perf_counter()
+        self.stages = dict()
+        self.templates = []
+        self.utcNow = 0
+        self.outcome = None
+        self.entries = []
+        self.totals = dict()
+        self.outputs = dict()
+        self.delta = None
+        self.previousSeconds = dict()
     
-    canvasImage = createCanvas()
-    autoPickImage = createCanvas()
-    maskImage = createCanvas(isMask=True)
+    def addStageTime(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0) + seconds
     
-    enduGroups = dict()
+    @contextlib.contextmanager
+    def timeStage(self, stage):
+        startTime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.addStageTime(stage, time.perf_counter() - startTime)
     
-    utcNow = int(datetime.datetime.utcnow().timestamp())
-    for templateEntry in templates:
-        if ("enabled_utc" in templateEntry and int(templateEntry["enabled_utc"]) > utcNow):
-            print("skip {0} due to future animation frame ({1:.02f}h)".format(templateEntry["name"], (int(templateEntry["enabled_utc"])-utcNow)/3600.0))
-            continue
+    def describeEntry(self, templateEntry, fetcher):
+        timings = templateEntry.get("__timings", dict())
+        entryReport = {"name": templateEntry["name"]}
+        for stage in reportEntryStages:
+            entryReport[stage + "_seconds"] = timings.get(stage, 0)
+        
+        # transfers happen on the fetcher's threads, so they are looked up by the sources this entry tried
+        triedSources = [failedSource["source"] for failedSource in templateEntry.get("__failed_sources", [])]
+        if "__source" in templateEntry:
+            triedSources.append(templateEntry["__source"])
+        transfers = [fetcher.statistics[source] for source in triedSources if source in fetcher.statistics]
         
-        print("render {0}".format(templateEntry["name"]))
-        with (
-        loadTemplateEntryImage(templateEntry, subfolder) as image,
-        generateTransparencyMask(image) as transparencyMaskImage):
-            if ("__exclude" in templateEntry):
-                eraseFromCanvas(templateEntry, transparencyMaskImage, canvasImage)
+        entryReport["fetch_seconds"] = sum(transfer["seconds"] for transfer in transfers)
+        entryReport["bytes"] = sum(transfer["bytes"] for transfer in transfers)
+        entryReport["source"] = templateEntry.get("__source")
+        entryReport["source_header"] = templateEntry.get("__header")
+        entryReport["failed_sources"] = templateEntry.get("__failed_sources", [])
+        entryReport["retries"] = len(entryReport["failed_sources"]) + sum(transfer["retries"] for transfer in transfers)
+        entryReport["autopick_excluded"] = "__noauto" in templateEntry
+        entryReport["culled"] = "__culled" in templateEntry
+        if entryReport["culled"]:
+            entryReport["estimated_seconds_saved"] = self.previousSeconds.get(templateEntry["name"], 0)
+        
+        # drawn from last good copies because the Endu template or the image couldn't be fetched this time
+        entryReport["stale"] = []
+        for staleSource in [templateEntry.get("__endu"), templateEntry.get("__source")]:
+            if staleSource in fetcher.stale:
+                staleCopy = fetcher.stale[staleSource]
+                entryReport["stale"].append({"source": staleSource, "age_hours": (self.utcNow - staleCopy["utc"]) / 3600, "error": staleCopy["error"]})
+        entryReport["total_seconds"] = timings.get("load", 0) + timings.get("priority_mask", 0) + timings.get("composite", 0) + timings.get("fingerprint", 0)
+        return entryReport
+    
+    def readPreviousSeconds(self, subfolder):
+        # what drawing each entry took in the last build, so culling it can be priced
+        self.previousSeconds = dict()
+        try:
+            with open(os.path.join(subfolder, "build_report.json"), "r", encoding="utf-8") as f:
+                previousEntries = json.loads(f.read())["entries"]
+        except (OSError, ValueError, KeyError):
+            return
+        for entryReport in previousEntries:
+            if entryReport.get("culled"):
+                self.previousSeconds[entryReport["name"]] = entryReport["estimated_seconds_saved"]
+            elif not "skipped" in entryReport:
+                self.previousSeconds[entryReport["name"]] = sum(entryReport.get(stage + "_seconds", 0) for stage in culledEntryStages)
+    
+    def collect(self, fetcher):
+        self.entries = []
+        for templateEntry in self.templates:
+            if not isTemplateEntryEnabled(templateEntry, self.utcNow):
+                self.entries.append({"name": templateEntry["name"], "skipped": "enabled_utc {0}".format(templateEntry["enabled_utc"])})
             else:
-                copyTemplateEntryIntoCanvas(templateEntry, image, canvasImage)
+                self.entries.append(self.describeEntry(templateEntry, fetcher))
+        
+        rendered = [entryReport for entryReport in self.entries if not "skipped" in entryReport]
+        self.totals = {
+            "seconds": time.perf_counter() - self.startTime,
+            "entries": len(rendered),
+            "bytes": sum(statistics["bytes"] for statistics in fetcher.statistics.values()),
+            "requests": len([statistics for statistics in fetcher.statistics.values() if statistics["status"] != "preloaded"]),
+            "not_modified": len([statistics for statistics in fetcher.statistics.values() if statistics["status"] == 304]),
+            "failed_requests": len([statistics for statistics in fetcher.statistics.values() if "error" in statistics]),
+            "stale_entries": len([entryReport for entryReport in rendered if len(entryReport["stale"]) > 0]),
+            "culled_entries": len([entryReport for entryReport in rendered if entryReport["culled"]]),
+            "estimated_seconds_saved": sum(entryReport.get("estimated_seconds_saved", 0) for entryReport in rendered),
+            "unreachable_hosts": fetcher.getOpenCircuits(),
+            "peak_rss_mb": getPeakRssMegabytes(),
+        }
+        for stage in reportEntryStages + ["fetch"]:
+            self.totals[stage + "_seconds"] = sum(entryReport[stage + "_seconds"] for entryReport in rendered)
+    
+    def write(self, subfolder, fetcher):
+        self.readPreviousSeconds(subfolder)
+        self.collect(fetcher)
+        reportObject = {
+            "outcome": self.outcome,
+            "utc": self.utcNow,
+            "stages": self.stages,
+            "totals": self.totals,
+            "outputs": self.outputs,
+            "delta": self.delta,
+            "downloads": fetcher.statistics,
+            "entries": self.entries,
+        }
+        try:
+            with open(os.path.join(subfolder, "build_report.json"), "w", encoding="utf-8") as f:
+                f.write(json.dumps(reportObject, indent=4))
+        except OSError as e:
+            print("unable to write build report: {0}".format(e))
+    
+    def printSummary(self):
+        stages = ", ".join("{0} {1:.2f}s".format(stage, seconds) for (stage, seconds) in self.stages.items())
+        peakRss = self.totals["peak_rss_mb"]
+        print("{0} in {1:.2f}s ({2}), {3} requests, {4} bytes, peak RSS {5}".format(self.outcome, self.totals["seconds"], stages, self.totals["requests"], self.totals["bytes"], "{0:.0f} MB".format(peakRss) if peakRss else "unknown"))
+        
+        if len(self.outputs) > 0:
+            outputBytes = sum(outputReport["bytes"] for outputReport in self.outputs.values())
+            encodeTime = sum(outputReport["encode_seconds"] for outputReport in self.outputs.values())
+            comparison = ""
+            if outputSettings["compare"]:
+                rgbaBytes = sum(outputReport["rgba_bytes"] for outputReport in self.outputs.values())
+                rgbaEncodeTime = sum(outputReport["rgba_encode_seconds"] for outputReport in self.outputs.values())
+                comparison = " (RGBA: {0} bytes in {1:.2f}s)".format(rgbaBytes, rgbaEncodeTime)
+            print("wrote {0} outputs, {1} bytes in {2:.2f}s{3}".format(len(self.outputs), outputBytes, encodeTime, comparison))
+        
+        staleEntries = [entryReport for entryReport in self.entries if len(entryReport.get("stale", [])) > 0]
+        if len(staleEntries) > 0:
+            print("{0} stale entries:".format(len(staleEntries)))
+            for entryReport in staleEntries:
+                oldest = max(staleCopy["age_hours"] for staleCopy in entryReport["stale"])
+                print("\t{0} from {1:.1f}h ago".format(entryReport["name"], oldest))
+        if self.totals["culled_entries"] > 0:
+            print("culled {0} entries covered by later ones, saving about {1:.2f}s".format(self.totals["culled_entries"], self.totals["estimated_seconds_saved"]))
+        if len(self.totals["unreachable_hosts"]) > 0:
+            print("gave up on {0}".format(", ".join(self.totals["unreachable_hosts"])))
+        
+        rendered = [entryReport for entryReport in self.entries if not "skipped" in entryReport and entryReport["total_seconds"] > 0]
+        if len(rendered) == 0:
+            return
+        print("slowest entries:")
+        for entryReport in sorted(rendered, key = lambda entryReport: -entryReport["total_seconds"])[0:slowestEntryCount]:
+            stages = ", ".join("{0} {1:.3f}s".format(stage, entryReport[stage + "_seconds"]) for stage in ["fetch"] + reportEntryStages if entryReport[stage + "_seconds"] >= 0.0005)
+            print("\t{0:.3f}s {1} ({2}) from {3}".format(entryReport["total_seconds"], entryReport["name"], stages, entryReport["source"]))
+
+def main(subfolder, cache = None, incremental = False):
+    with RemoteFetcher(cache = cache, deadline = getBuildDeadline()) as fetcher:
+        assembleAndReport(subfolder, fetcher, incremental)
+
+def assembleAndReport(subfolder, fetcher, incremental = False, memory = None, report = None):
+    if report is None:
+        report = BuildReport()
+    try:
+        report.outcome = assemble(subfolder, fetcher, incremental, report, memory)
+    except Exception as e:
+        report.outcome = "failed: {0}".format(e)
+        raise
+    finally:
+        report.write(subfolder, fetcher)
+        report.printSummary()
+
+def isBuildCurrent(subfolder, previousState, fingerprint):
+    if previousState is None or previousState["fingerprint"] != fingerprint:
+        return False
+    for (name, previousOutput) in previousState["outputs"].items():
+        if hashFile(os.path.join(subfolder, name + ".png")) != previousOutput["file"]:
+            return False
+    requiredFiles = ["endu_template.json", "version.txt"]
+    if outputSettings["hashed"]:
+        requiredFiles.append("manifest.json")
+    return all(os.path.isfile(os.path.join(subfolder, outputFile)) for outputFile in requiredFiles)
+
+def assemble(subfolder, fetcher, incremental = False, report = None, memory = None):
+    if report is None:
+        report = BuildReport()
+    
+    global canvasSize
+    with report.timeStage("resolve"):
+        templateFile = loadTemplate(subfolder)
+        canvasSize = getCanvasSize(templateFile)
+        templates = getTemplates(templateFile, fetcher)
+    
+    utcNow = int(datetime.datetime.utcnow().timestamp())
+    report.templates = templates
+    report.utcNow = utcNow
+    with report.timeStage("prefetch"):
+        prefetchTemplateImages(templates, fetcher, utcNow)
+    with report.timeStage("animate"):
+        selectAnimationFrames(templates, subfolder, fetcher, utcNow)
+    
+    buildState = None
+    if incremental:
+        previousState = fetcher.cache.loadBuildState(subfolder)
+        with report.timeStage("fingerprint"):
+            fingerprint = fingerprintBuild(templateFile, templates, subfolder, fetcher, utcNow)
+        if isBuildCurrent(subfolder, previousState, fingerprint):
+            print("nothing changed since the last build")
+            return "up to date"
+        buildState = {"previous": previousState["outputs"] if previousState else dict(), "outputs": dict(), "changed": False}
+    
+    planes = {"canvas": createPlane(canvasSize), "autopick": createPlane(canvasSize), "mask": createPlane(canvasSize)}
+    animations = []
+    
+    enduGroups = dict()
+    enduIndex = ExtentsIndex()
+    
+    if renderSettings["cull"]:
+        with report.timeStage("plan"):
+            planOcclusion(templates, subfolder, fetcher, utcNow)
+    
+    renderStartTime = time.perf_counter()
+    rendered = [templateEntry for templateEntry in templates if isTemplateEntryEnabled(templateEntry, utcNow) and not "__culled" in templateEntry]
+    with EntryPipeline(rendered, subfolder, fetcher, memory, getPipelineWorkers()) as pipeline:
+        for templateEntry in templates:
+            if not isTemplateEntryEnabled(templateEntry, utcNow):
+                print("skip {0} due to future animation frame ({1:.02f}h)".format(templateEntry["name"], (int(templateEntry["enabled_utc"])-utcNow)/3600.0))
+                continue
+            if "__culled" in templateEntry:
+                print("skip {0}, covered by later entries".format(templateEntry["name"]))
+                continue
             
-            if ("autopick" in templateEntry and bool(templateEntry["autopick"]) and not "__noauto" in templateEntry):
-                copyTemplateEntryIntoCanvas(templateEntry, image, autoPickImage)
-                with generatePriorityMask(templateEntry, image) as priorityMask:
-                    copyTemplateEntryIntoCanvas(templateEntry, priorityMask, maskImage)
-            else:
-                eraseFromCanvas(templateEntry, transparencyMaskImage, autoPickImage)
-                eraseFromCanvas(templateEntry, transparencyMaskImage, maskImage, isMask=True)
+            print("render {0}".format(templateEntry["name"]))
+            with timeEntryStage(templateEntry, "load"):
+                loadedEntry = pipeline.load(templateEntry)
+            indices = loadedEntry["indices"]
             
-            if ("export_group" in templateEntry and str(templateEntry["export_group"]) != ""):
-                (enduImage, enduExtents) = getEnduGroup(enduGroups, str(templateEntry["export_group"]))
-                copyTemplateEntryIntoCanvas(templateEntry, image, enduImage)
-                updateExtents(templateEntry, image, enduExtents)
-            else:
-                for (groupName, (enduImage, enduExtents)) in enduGroups.items():
-                    eraseFromCanvas(templateEntry, transparencyMaskImage, enduImage)
+            animation = None
+            if isTemplateEntryAnimated(templateEntry):
+                with timeEntryStage(templateEntry, "animate"):
+                    try:
+                        animation = loadAnimation(templateEntry, subfolder, fetcher, planes)
+                    except Exception as e:
+                        print("\tonly drawing the current frame of {0}: {1}".format(templateEntry["name"], e))
+            
+            isAutoPick = isTemplateEntryAutoPick(templateEntry)
+            priorityValues = None
+            if isAutoPick:
+                with timeEntryStage(templateEntry, "priority_mask"):
+                    priorityValues = getPriorityValues(templateEntry, loadedEntry, fetcher.cache)
+            
+            with timeEntryStage(templateEntry, "composite"):
+                opaque = indices != 0
+                entrySize = getPlaneSize(indices)
+                checkTemplateEntryOnCanvas(templateEntry, entrySize)
+                
+                paintOutputs(planes, (0, 0), templateEntry, indices, opaque, priorityValues)
+                for coveredAnimation in animations:
+                    paintPlane(coveredAnimation["covered"], coveredAnimation["rectangle"][0:2], templateEntry, opaque, True)
+                if animation is not None:
+                    animations.append(animation)
+                
+                if isExportGroupEntry(templateEntry):
+                    enduExtents = addToEnduGroup(enduGroups, str(templateEntry["export_group"]), templateEntry, indices, opaque)
+                    enduIndex.update(str(templateEntry["export_group"]), enduExtents)
+                else:
+                    for groupName in enduIndex.findIntersecting(getEntryRectangle(templateEntry, entrySize)):
+                        (enduPlane, enduExtents) = enduGroups[groupName]
+                        paintPlane(enduPlane, (enduExtents["x1"], enduExtents["y1"]), templateEntry, opaque, 0)
+    report.addStageTime("render", time.perf_counter() - renderStartTime)
     
-    writeCanvas(canvasImage, subfolder, "canvas")
-    writeCanvas(autoPickImage, subfolder, "autopick")
-    writeCanvas(maskImage, subfolder, "mask")
+    with report.timeStage("write"):
+        previousPlanes = readOutputPlanes(subfolder) if outputSettings["deltas"] else None
+        outputFiles = []
+        for (name, plane) in planes.items():
+            writePlane(plane, subfolder, name, buildState, report, isMask = name == "mask")
+            outputFiles.append(name + ".png")
+        outputFiles += writeTiles(planes, subfolder, buildState, report)
+        
+        outputFiles += writeEnduInfos(enduGroups, templateFile["endu_info"], subfolder, buildState, report)
+        outputFiles += writeAnimations(animations, planes, subfolder, buildState, report)
     
-    writeEnduInfos(enduGroups, templateFile["endu_info"], subfolder)
+    if buildState is not None:
+        fetcher.cache.storeBuildState(subfolder, {"fingerprint": fingerprint, "outputs": buildState["outputs"]})
     
-    canvasImage.close()
-    autoPickImage.close()
-    maskImage.close()
+    if buildState is None or buildState["changed"]:
+        version = updateVersion(subfolder)
+        if outputSettings["deltas"]:
+            with report.timeStage("write"):
+                writeDeltas(subfolder, previousPlanes, planes, version, utcNow, report)
+        outcome = "built"
+    else:
+        print("outputs unchanged, keeping version")
+        outcome = "built, outputs unchanged"
     
-    updateVersion(subfolder)
+    with report.timeStage("write"):
+        if outputSettings["hashed"]:
+            if outputSettings["deltas"]:
+                outputFiles.append("deltas.json")
+            publishOutputs(subfolder, outputFiles)
+        else:
+            unpublishOutputs(subfolder)
+    return outcome
+
+def findBatchSources(templates, subfolder, fetcher, utcNow):
+    # the source each enabled entry will most likely end up using, see loadTemplateEntryImage. entries that
+    # only use a region of their source normalize just that region themselves
+    sourceBytes = []
+    for templateEntry in templates:
+        if not isTemplateEntryEnabled(templateEntry, utcNow) or "__region" in templateEntry:
+            continue
+        for imageSource in templateEntry["images"]:
+            try:
+                sourceBytes.append(readTemplateEntrySource(imageSource, subfolder, fetcher))
+                break
+            except Exception:
+                continue
+    return sourceBytes
+
+def getWorkerSettings():
+    # whatever the command line changed, for worker processes
+    return {"output": dict(outputSettings), "render": dict(renderSettings), "sources": dict(sourceLimits), "fetch": dict(fetchSettings)}
+
+def applyWorkerSettings(settings):
+    # workers are not guaranteed to be forked from a process that parsed the command line
+    outputSettings.update(settings["output"])
+    renderSettings.update(settings["render"])
+    sourceLimits.update(settings["sources"])
+    fetchSettings.update(settings["fetch"])
+
+def normalizeBatchSource(cacheDir, cacheBytes, settings, sourceBytes):
+    applyWorkerSettings(settings)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        cache = FetchCache(cacheDir, cacheBytes)
+        contentHash = hashlib.sha256(sourceBytes).hexdigest()
+        try:
+            if not cache.hasImage("normalized", contentHash):
+                decodeTemplateEntrySource(sourceBytes, contentHash, cache)[0].close()
+                cache.save()
+        except Exception as e:
+            # the folder builds will fall back to the entry's other sources
+            print("\tnot normalizing {0}: {1}".format(contentHash[0:12], e))
+    return output.getvalue()
+
+def assembleBatchFolder(subfolder, cacheDir, cacheBytes, incremental, preloaded, settings, deadline):
+    applyWorkerSettings(settings)
+    # the folders already keep every cpu busy
+    renderSettings["workers"] = 1
+    output = io.StringIO()
+    startTime = time.perf_counter()
+    succeeded = True
+    with contextlib.redirect_stdout(output):
+        try:
+            cache = FetchCache(cacheDir, cacheBytes) if cacheDir else None
+            with RemoteFetcher(cache = cache, preloaded = preloaded, deadline = deadline) as fetcher:
+                assembleAndReport(subfolder, fetcher, incremental)
+        except Exception:
+            traceback.print_exc(file = output)
+            succeeded = False
+    return (succeeded, output.getvalue(), time.perf_counter() - startTime)
+
+def readVersion(subfolder):
+    try:
+        with open(os.path.join(subfolder, "version.txt"), "r", encoding="utf-8") as versionFile:
+            return versionFile.read().strip()
+    except OSError:
+        return "-"
+
+def batchMain(subfolders, cache = None, incremental = False, workers = None):
+    # builds several folders at once. downloads happen once up front in this process, normalizing each
+    # distinct source image happens once in the pool, then every folder is assembled in its own worker
+    startTime = time.perf_counter()
+    results = dict()
+    sharedSources = dict()
+    
+    # one deadline for the downloads up front and every folder's build
+    deadline = getBuildDeadline()
+    with RemoteFetcher(cache = cache, deadline = deadline) as fetcher:
+        utcNow = int(datetime.datetime.utcnow().timestamp())
+        for subfolder in subfolders:
+            try:
+                templates = getTemplates(loadTemplate(subfolder), fetcher)
+                prefetchTemplateImages(templates, fetcher, utcNow)
+                for sourceBytes in findBatchSources(templates, subfolder, fetcher, utcNow):
+                    sharedSources[hashlib.sha256(sourceBytes).hexdigest()] = sourceBytes
+            except Exception as e:
+                results[subfolder] = (False, "failed to resolve templates: {0}\n".format(e), 0)
+        preloaded = fetcher.getResults()
+    
+    cacheDir = cache.cacheDir if cache else None
+    cacheBytes = cache.maxBytes if cache else 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers = workers) as pool:
+        if cache:
+            print("normalize {0} distinct images".format(len(sharedSources)))
+            for output in pool.map(normalizeBatchSource, itertools.repeat(cacheDir), itertools.repeat(cacheBytes), itertools.repeat(getWorkerSettings()), sharedSources.values()):
+                print(output, end = "")
+        
+        folderBuilds = dict()
+        for subfolder in subfolders:
+            if not subfolder in results:
+                folderBuilds[subfolder] = pool.submit(assembleBatchFolder, subfolder, cacheDir, cacheBytes, incremental, preloaded, getWorkerSettings(), deadline)
+        for (subfolder, folderBuild) in folderBuilds.items():
+            results[subfolder] = folderBuild.result()
+    
+    for subfolder in subfolders:
+        print("==== {0}".format(subfolder))
+        print(results[subfolder][1], end = "")
+    
+    print("==== summary ({0:.2f}s)".format(time.perf_counter() - startTime))
+    for subfolder in subfolders:
+        (succeeded, output, elapsed) = results[subfolder]
+        print("{0:<6} {1:6.2f}s  version {2:<5} {3}".format("ok" if succeeded else "FAILED", elapsed, readVersion(subfolder), subfolder))
+    
+    return 0 if all(results[subfolder][0] for subfolder in subfolders) else 1
+
+watchPollInterval = 0.1
+watchNativePollInterval = 1
+defaultWatchRefreshMinutes = 10
+
+# serves a template folder like the real hosts do for the userscript: ETags from the file contents,
+# revalidation on every request, and never a build that is only half written
+class OutputRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    contentTypes = {
+        ".png": "image/png",
+        ".json": "application/json",
+        ".txt": "text/plain; charset=utf-8",
+        ".bin": "application/octet-stream",
+    }
+    
+    def do_GET(self):
+        subfolder = os.path.abspath(self.server.subfolder)
+        requestPath = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).lstrip("/")
+        filePath = os.path.abspath(os.path.join(subfolder, requestPath))
+        contentType = self.contentTypes.get(os.path.splitext(filePath)[1])
+        if not filePath.startswith(subfolder + os.sep) or contentType is None:
+            self.send_error(404)
+            return
+        
+        try:
+            with self.server.buildLock:
+                with open(filePath, "rb") as f:
+                    body = f.read()
+        except OSError:
+            self.send_error(404)
+            return
+        
+        etag = "\"{0}\"".format(hashlib.sha256(body).hexdigest()[0:32])
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            body = b""
+        else:
+            self.send_response(200)
+            self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        if requestPath.startswith(publishedFolder + "/"):
+            # named after their contents, see publishOutputs
+            self.send_header("Cache-Control", "public, max-age=31536000, immutable")
+        else:
+            self.send_header("Cache-Control", "no-cache")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Expose-Headers", "ETag")
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+# wakes the watch loop as soon as something in the folder changes. without watchdog installed the loop
+# simply polls more often; either way the file snapshot decides whether anything is rebuilt
+class FolderWatcher:
+    def __init__(self, subfolder):
+        self.changed = threading.Event()
+        self.observer = None
+        self.pollInterval = watchPollInterval
+        if watchdog is not None:
+            eventHandler = watchdog.events.FileSystemEventHandler()
+            eventHandler.on_any_event = lambda event: self.changed.set()
+            self.observer = watchdog.observers.Observer()
+            self.observer.schedule(eventHandler, subfolder, recursive = True)
+            self.observer.start()
+            self.pollInterval = watchNativePollInterval
+    
+    def wait(self):
+        self.changed.wait(self.pollInterval)
+        self.changed.clear()
+    
+    def close(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+
+def getWatchedFiles(subfolder, templates):
+    watchedFiles = set([os.path.join(subfolder, "template.json")])
+    for templateEntry in templates:
+        for imageSource in templateEntry.get("images", []):
+            if not imageSource.startswith("http"):
+                watchedFiles.add(os.path.join(subfolder, imageSource))
+    return watchedFiles
+
+def getFileSnapshot(watchedFiles):
+    snapshot = dict()
+    for filePath in watchedFiles:
+        try:
+            fileStat = os.stat(filePath)
+            snapshot[filePath] = (fileStat.st_mtime_ns, fileStat.st_size)
+        except OSError:
+            snapshot[filePath] = None
+    return snapshot
+
+def watchMain(subfolder, cache, host, port, refreshMinutes = defaultWatchRefreshMinutes):
+    # rebuilds the folder whenever template.json or a local source changes and serves the outputs. entries
+    # stay decoded in memory between builds, and remote templates are only fetched again every refreshMinutes
+    buildLock = threading.Lock()
+    server = http.server.ThreadingHTTPServer((host, port), OutputRequestHandler)
+    server.daemon_threads = True
+    server.subfolder = subfolder
+    server.buildLock = buildLock
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    print("serving {0} on http://{1}:{2}/, watching for changes{3}".format(subfolder, host, server.server_address[1], "" if watchdog else " by polling"))
+    
+    memory = EntryMemory()
+    watcher = FolderWatcher(subfolder)
+    fetcher = None
+    watchedFiles = getWatchedFiles(subfolder, [])
+    lastSnapshot = None
+    try:
+        while True:
+            if fetcher is None or time.monotonic() - fetcherStartTime > refreshMinutes * 60:
+                if fetcher is not None:
+                    fetcher.close()
+                    print("refreshing remote templates")
+                fetcher = RemoteFetcher(cache = cache)
+                fetcherStartTime = time.monotonic()
+                lastSnapshot = None
+            
+            snapshot = getFileSnapshot(watchedFiles)
+            if snapshot != lastSnapshot:
+                # changes made while building are caught by the next snapshot
+                lastSnapshot = snapshot
+                report = BuildReport()
+                fetcher.deadline = getBuildDeadline()
+                with buildLock:
+                    try:
+                        assembleAndReport(subfolder, fetcher, True, memory, report)
+                        memory.prune()
+                    except Exception:
+                        traceback.print_exc()
+                        print("build failed, still serving the last outputs")
+                
+                watchedFiles = getWatchedFiles(subfolder, report.templates)
+                for (filePath, fileState) in getFileSnapshot(watchedFiles - set(lastSnapshot)).items():
+                    lastSnapshot[filePath] = fileState
+                lastSnapshot = dict((filePath, lastSnapshot[filePath]) for filePath in watchedFiles)
+            
+            watcher.wait()
+    except KeyboardInterrupt:
+        print("stopping")
+    finally:
+        watcher.close()
+        server.shutdown()
+        if fetcher is not None:
+            fetcher.close()
+    return 0
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description = "Assembles the template images described by a template.json")
+    parser.add_argument("folders", nargs = "*", help = "folders containing template.json, several folders are built in parallel")
+    parser.add_argument("--cache-dir", default = defaultCacheDir, help = "where downloads and normalized images are cached (default: %(default)s)")
+    parser.add_argument("--cache-size", type = int, default = defaultCacheMegabytes, help = "cache size limit in MB (default: %(default)s)")
+    parser.add_argument("--no-cache", action = "store_true", help = "download and decode everything from scratch without touching the cache")
+    parser.add_argument("--incremental", action = "store_true", help = "skip the build when no entry changed and only rewrite outputs whose pixels changed")
+    parser.add_argument("--workers", type = int, default = None, help = "processes used when building several folders, or to decode the entries of a single folder, 1 decodes in this process (default: one per cpu)")
+    parser.add_argument("--no-cull", action = "store_true", help = "draw entries even when the cache shows that later entries cover them completely")
+    parser.add_argument("--encoding", choices = ["paletted", "rgba"], default = "paletted", help = "paletted writes the canvases with palette indices and the mask as grayscale with alpha (default: %(default)s)")
+    parser.add_argument("--compress-level", type = int, choices = range(0, 10), default = None, metavar = "0-9", help = "zlib compression level of output PNGs (default: 9, or 1 with --watch)")
+    parser.add_argument("--optimize", action = "store_true", help = "let the PNG encoder search for smaller output, slower")
+    parser.add_argument("--compare-encodings", action = "store_true", help = "also encode every output as plain RGBA and report both sizes and encode times")
+    parser.add_argument("--tile-size", type = int, default = 0, help = "also write canvas, autopick and mask as tiles of this size with a tiles.json manifest, each tile a slice of the full canvas planes (default: no tiles)")
+    parser.add_argument("--hashed-outputs", action = "store_true", help = "also publish every output under a name containing its content hash in published/, with manifest.json pointing to the current set")
+    parser.add_argument("--no-deltas", action = "store_true", help = "do not write per-version pixel deltas to deltas/ and deltas.json")
+    parser.add_argument("--delta-max-kb", type = int, default = 1024, help = "drop the oldest deltas once the chain is bigger than this (default: %(default)s)")
+    parser.add_argument("--delta-max-age", type = float, default = 48, help = "drop deltas older than this many hours (default: %(default)s)")
+    parser.add_argument("--source-max-mb", type = float, default = sourceLimits["bytes"] / 1048576, help = "give up on a source image bigger than this, checked while it downloads (default: %(default)s)")
+    parser.add_argument("--source-max-pixels", type = int, default = sourceLimits["pixels"], help = "reject source images with more pixels than this or the canvas area, whichever is more, before decoding them (default: %(default)s)")
+    parser.add_argument("--fetch-timeout", type = float, default = fetchSettings["timeout"], help = "seconds a remote host may take to connect or to send more data (default: %(default)s)")
+    parser.add_argument("--host-timeout", action = "append", default = [], metavar = "HOST=SECONDS", help = "a different --fetch-timeout for one host, as written in its urls, may be repeated")
+    parser.add_argument("--deadline", type = float, default = fetchSettings["deadline"], help = "seconds a build may spend fetching before remote entries fall back to their last good copy, 0 for no limit (default: %(default)s)")
+    parser.add_argument("--breaker-failures", type = int, default = fetchSettings["breaker_failures"], help = "give up on a host for the rest of the build after this many failures in a row (default: %(default)s)")
+    parser.add_argument("--watch", action = "store_true", help = "keep running, rebuild the folder whenever it changes and serve its outputs over HTTP")
+    parser.add_argument("--host", default = "127.0.0.1", help = "address --watch serves on (default: %(default)s)")
+    parser.add_argument("--port", type = int, default = 8000, help = "port --watch serves on (default: %(default)s)")
+    parser.add_argument("--watch-refresh", type = float, default = defaultWatchRefreshMinutes, help = "minutes between fetching remote templates again in --watch (default: %(default)s)")
+    parser.add_argument("--work-queue", metavar = "SNAPSHOT", help = "compare this PNG snapshot of the board with the folder's autopick.png and write the wrong pixels to work_queue.bin, highest priority first, then exit. - reads one snapshot after another from stdin and updates the queue after each")
+    parser.add_argument("--profile", help = "write cProfile statistics of the whole run to this file")
+    parser.add_argument("--cache-info", action = "store_true", help = "print what is in the cache and exit")
+    parser.add_argument("--clear-cache", action = "store_true", help = "delete the cache before doing anything else")
+    return parser.parse_args()
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Must provide a folder containing template.json as first arg")
-        sys.exit(1)
+    arguments = parseArguments()
     if not os.path.isfile(".build/template_assembler/assemble_template.py"):
         print("Must be invoked from repo root")
         sys.exit(1)
-    main(sys.argv[1])
\ No newline at end of file
+    
+    cache = FetchCache(arguments.cache_dir, arguments.cache_size * 1048576)
+    if arguments.clear_cache:
+        cache.clear()
+        print("cleared {0}".format(arguments.cache_dir))
+    if arguments.cache_info:
+        cache.describe()
+        sys.exit(0)
+    
+    if len(arguments.folders) == 0:
+        if arguments.clear_cache:
+            sys.exit(0)
+        print("Must provide a folder containing template.json as first arg")
+        sys.exit(1)
+    if (arguments.incremental or arguments.watch) and arguments.no_cache:
+        print("--incremental and --watch need the cache")
+        sys.exit(1)
+    if arguments.watch and len(arguments.folders) != 1:
+        print("--watch takes exactly one folder")
+        sys.exit(1)
+    if arguments.work_queue is not None:
+        if len(arguments.folders) != 1:
+            print("--work-queue takes exactly one folder")
+            sys.exit(1)
+        sys.exit(workQueueMain(arguments.folders[0], arguments.work_queue))
+    
+    # a local preview cares more about latency than about bytes
+    compressLevel = arguments.compress_level
+    if compressLevel is None:
+        compressLevel = 1 if arguments.watch else 9
+    outputSettings.update({"encoding": arguments.encoding, "compress_level": compressLevel, "optimize": arguments.optimize, "compare": arguments.compare_encodings, "tile_size": arguments.tile_size, "hashed": arguments.hashed_outputs,
+        "deltas": not arguments.no_deltas, "delta_max_bytes": arguments.delta_max_kb * 1024, "delta_max_age": arguments.delta_max_age * 3600})
+    renderSettings.update({"cull": not arguments.no_cull, "workers": arguments.workers})
+    sourceLimits.update({"bytes": int(arguments.source_max_mb * 1048576), "pixels": arguments.source_max_pixels})
+    hostTimeouts = dict()
+    for hostTimeout in arguments.host_timeout:
+        (host, seconds) = hostTimeout.rsplit("=", 1)
+        hostTimeouts[host] = float(seconds)
+    fetchSettings.update({"timeout": arguments.fetch_timeout, "host_timeouts": hostTimeouts, "deadline": arguments.deadline, "breaker_failures": arguments.breaker_failures})
+    
+    profiler = None
+    if arguments.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    
+    try:
+        if arguments.watch:
+            exitCode = watchMain(arguments.folders[0], cache, arguments.host, arguments.port, arguments.watch_refresh)
+        elif len(arguments.folders) == 1:
+            main(arguments.folders[0], None if arguments.no_cache else cache, arguments.incremental)
+            exitCode = 0
+        else:
+            exitCode = batchMain(arguments.folders, None if arguments.no_cache else cache, arguments.incremental, arguments.workers)
+    finally:
+        if profiler:
+            # only this process, folders built by batch workers are not included
+            profiler.disable()
+            profiler.dump_stats(arguments.profile)
+            print("profile written to {0}".format(arguments.profile))
+    sys.exit(exitCode)
@@ -0,0 +1,691 @@
+import argparse
+import concurrent.futures
+import contextlib
+import hashlib
+import http.server
+import io
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+import numpy as np
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import assemble_template as assembler
+
+def generateNoisyImage(size, noiseRatio = 0.05, transparentRatio = 0.2, seed = 1):
+    rng = random.Random(seed)
+    paletteColors = list(assembler.palette)
+    data = bytearray()
+    for i in range(size[0] * size[1]):
+        roll = rng.random()
+        if roll < transparentRatio:
+            data.extend((0, 0, 0, rng.randrange(0, 128)))
+        elif roll < transparentRatio + noiseRatio:
+            data.extend((rng.randrange(256), rng.randrange(256), rng.randrange(256), rng.randrange(128, 256)))
+        else:
+            data.extend(rng.choice(paletteColors))
+    return Image.frombytes("RGBA", size, bytes(data))
+
+def generateSpriteImage(size, blobCount = 40, seed = 1):
+    # opaque blobs on a transparent background, with enough interior for every mask ring
+    rng = random.Random(seed)
+    paletteColors = list(assembler.palette)
+    image = Image.new("RGBA", size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    for i in range(blobCount):
+        (x, y) = (rng.randrange(size[0]), rng.randrange(size[1]))
+        radius = rng.randrange(3, max(4, min(size) // 6))
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill = rng.choice(paletteColors))
+    for i in range(size[0] * size[1] // 50):
+        draw.point((rng.randrange(size[0]), rng.randrange(size[1])), (0, 0, 0, 0))
+    return image
+
+def timeCall(function, *args):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+    # report lines come from a set, so only their contents are comparable
+    return (elapsed, (result, sorted(output.getvalue().splitlines())))
+
+def benchmarkNormalize(size = (1000, 1000)):
+    print("normalize {0}x{1} noisy image".format(size[0], size[1]))
+    with generateNoisyImage(size) as source:
+        perPixelImage = source.copy()
+        vectorImage = source.copy()
+
+    (perPixelTime, perPixelResult) = timeCall(assembler.normalizeImagePerPixel, perPixelImage)
+    (vectorTime, vectorResult) = timeCall(assembler.normalizeImage, vectorImage)
+
+    if perPixelResult != vectorResult or perPixelImage.tobytes() != vectorImage.tobytes():
+        raise RuntimeError("normalizeImage disagrees with the per-pixel reference")
+
+    print("\tper-pixel {0:.3f}s, vectorized {1:.3f}s ({2:.1f}x)".format(perPixelTime, vectorTime, perPixelTime / vectorTime))
+    perPixelImage.close()
+    vectorImage.close()
+    return {"per_pixel_seconds": perPixelTime, "vectorized_seconds": vectorTime}
+
+def comparePriorityMasks(templateEntry, image):
+    (perPixelTime, perPixelMask) = timeCall(assembler.generatePriorityMaskPerPixel, templateEntry, image)
+    (vectorTime, vectorMask) = timeCall(assembler.generatePriorityMask, templateEntry, image)
+    
+    if perPixelMask[0].tobytes() != vectorMask[0].tobytes():
+        raise RuntimeError("generatePriorityMask disagrees with the per-pixel reference for {0}".format(templateEntry["name"]))
+    
+    perPixelMask[0].close()
+    vectorMask[0].close()
+    return (perPixelTime, vectorTime)
+
+def benchmarkPriorityMask(size = (1000, 1000)):
+    print("priority mask {0}x{1} sprite".format(size[0], size[1]))
+    with generateSpriteImage(size) as sprite:
+        (perPixelTime, vectorTime) = comparePriorityMasks({"name": "sprite", "priority": 5}, sprite)
+    print("\tper-pixel {0:.3f}s, vectorized {1:.3f}s ({2:.1f}x)".format(perPixelTime, vectorTime, perPixelTime / vectorTime))
+    return {"per_pixel_seconds": perPixelTime, "vectorized_seconds": vectorTime}
+
+def checkSmallPriorityMasks(count = 600, seed = 1):
+    # images of 1 to 14 pixels a side, where nearly every pixel is on the border or near the lower-left
+    # look-ahead that findEdgePixels reproduces, from fully transparent to fully opaque
+    print("priority masks for {0} small images".format(count))
+    rng = np.random.default_rng(seed)
+    for i in range(0, count):
+        (width, height) = (int(rng.integers(1, 15)), int(rng.integers(1, 15)))
+        opaque = rng.random((height, width)) < rng.random()
+        pixels = assembler.paletteArray[rng.integers(0, len(assembler.paletteArray), (height, width))]
+        pixels[~opaque] = 0
+        with Image.fromarray(pixels, "RGBA") as image:
+            comparePriorityMasks({"name": "small image {0} ({1}x{2})".format(i, width, height), "priority": int(rng.integers(1, 11))}, image)
+    print("\tall {0} match".format(count))
+    return {"images": count}
+
+def checkSourceRegions(count = 200, seed = 1):
+    # frames of a sprite sheet are decoded with the decoder stopped after their last row, which has to give
+    # the same pixels as decoding the whole sheet and cropping it
+    print("decode {0} sprite sheet regions".format(count))
+    rng = np.random.default_rng(seed)
+    shortened = 0
+    for i in range(0, count):
+        (width, height) = (int(rng.integers(1, 80)), int(rng.integers(1, 80)))
+        (regionWidth, regionHeight) = (int(rng.integers(1, width + 1)), int(rng.integers(1, height + 1)))
+        region = (int(rng.integers(0, width - regionWidth + 1)), int(rng.integers(0, height - regionHeight + 1)), regionWidth, regionHeight)
+        with generateSpriteImage((width, height), seed = i) as sprite, sprite.convert(["RGBA", "RGB", "P", "LA"][i % 4]) as converted:
+            sheetBytes = encodePng(converted)
+        with Image.open(io.BytesIO(sheetBytes)) as rawImage:
+            shortened += assembler.canDecodeSourceRows(rawImage)
+            with assembler.decodeSourceRegion(rawImage, region) as regionImage:
+                regionPixels = np.asarray(regionImage.convert("RGBA"))
+        with Image.open(io.BytesIO(sheetBytes)) as rawImage, rawImage.crop((region[0], region[1], region[0] + regionWidth, region[1] + regionHeight)) as croppedImage:
+            croppedPixels = np.asarray(croppedImage.convert("RGBA"))
+        if not np.array_equal(regionPixels, croppedPixels):
+            raise RuntimeError("region {0} of sheet {1} ({2}x{3}) differs from a plain crop".format(region, i, width, height))
+    print("\tall {0} match, {1} decoded only down to the region".format(count, shortened))
+    return {"regions": count, "shortened": shortened}
+
+def checkShippedPriorityMasks(subfolder = "templates/mlp"):
+    # regression check on real art; sources that are not checked out (e.g. LFS pointers) are skipped, and
+    # the check fails when that leaves nothing to compare
+    print("priority masks for {0}".format(subfolder))
+    matched = []
+    templateFile = assembler.loadTemplate(subfolder)
+    for templateEntry in templateFile["templates"]:
+        if not "images" in templateEntry or templateEntry["images"][0].startswith("http"):
+            continue
+        try:
+            with assembler.RemoteFetcher() as fetcher:
+                (loadTime, (image, loadReport)) = timeCall(assembler.loadTemplateEntryImage, dict(templateEntry), subfolder, fetcher)
+        except Exception as e:
+            print("\tskip {0}: {1}".format(templateEntry["name"], e))
+            continue
+        with image:
+            comparePriorityMasks(templateEntry, image)
+        print("\tmatch {0}".format(templateEntry["name"]))
+        matched.append(templateEntry["name"])
+    if len(matched) == 0:
+        print("\tFAILED: no image of {0} could be loaded, is the art checked out (git lfs pull)?".format(subfolder))
+    return {"matched": matched, "passed": len(matched) > 0}
+
+def compositeExportGroupsRgba(placedEntries):
+    # what compositing did before planes: a full RGBA canvas per group, and every entry outside a group
+    # erased from all of them through a freshly allocated blank image
+    enduGroups = dict()
+    for (templateEntry, image, indices) in placedEntries:
+        with image.getchannel("A").point(lambda a: 0 if a == 0 else 255) as transparencyMask:
+            if "export_group" in templateEntry:
+                if not templateEntry["export_group"] in enduGroups:
+                    enduGroups[templateEntry["export_group"]] = (assembler.createImage(assembler.canvasSize, False), dict())
+                (enduImage, enduExtents) = enduGroups[templateEntry["export_group"]]
+                enduImage.alpha_composite(image, (templateEntry["x"], templateEntry["y"]))
+                assembler.updateExtents(templateEntry, image.size, enduExtents)
+            else:
+                for (enduImage, enduExtents) in enduGroups.values():
+                    with assembler.createImage(image.size, False) as blankImage:
+                        enduImage.paste(blankImage, (templateEntry["x"], templateEntry["y"]), transparencyMask)
+    
+    crops = dict()
+    for (groupName, (enduImage, enduExtents)) in enduGroups.items():
+        with enduImage.crop((enduExtents["x1"], enduExtents["y1"], enduExtents["x2"], enduExtents["y2"])) as enduCrop:
+            crops[groupName] = enduCrop.tobytes()
+        enduImage.close()
+    return crops
+
+def compositeExportGroupsPlanes(placedEntries):
+    enduGroups = dict()
+    enduIndex = assembler.ExtentsIndex()
+    for (templateEntry, image, indices) in placedEntries:
+        opaque = indices != 0
+        if "export_group" in templateEntry:
+            enduExtents = assembler.addToEnduGroup(enduGroups, templateEntry["export_group"], templateEntry, indices, opaque)
+            enduIndex.update(templateEntry["export_group"], enduExtents)
+        else:
+            for groupName in enduIndex.findIntersecting(assembler.getEntryRectangle(templateEntry, image.size)):
+                (enduPlane, enduExtents) = enduGroups[groupName]
+                assembler.paintPlane(enduPlane, (enduExtents["x1"], enduExtents["y1"]), templateEntry, opaque, 0)
+    
+    crops = dict()
+    for (groupName, (enduPlane, enduExtents)) in enduGroups.items():
+        with assembler.convertPlaneToImage(enduPlane) as enduImage, enduImage.convert("RGBA") as rgbaImage:
+            crops[groupName] = rgbaImage.tobytes()
+    return crops
+
+def benchmarkExportGroups(entryCount = 400, groupCount = 12, seed = 1):
+    print("export groups for {0} entries in {1} groups".format(entryCount, groupCount))
+    rng = random.Random(seed)
+    placedEntries = []
+    for i in range(0, entryCount):
+        image = generateSpriteImage((rng.randrange(10, 60), rng.randrange(10, 60)), blobCount = 3, seed = i)
+        templateEntry = {"name": "entry{0}".format(i), "x": rng.randrange(0, assembler.canvasSize[0] - image.width), "y": rng.randrange(0, assembler.canvasSize[1] - image.height)}
+        if rng.random() < 0.1:
+            # groups stay local like our real ones, each one near its own spot on the canvas
+            groupIndex = rng.randrange(0, groupCount)
+            templateEntry["export_group"] = "group{0}".format(groupIndex)
+            templateEntry["x"] = (groupIndex * 83) % (assembler.canvasSize[0] - 160) + rng.randrange(0, 100)
+            templateEntry["y"] = (groupIndex * 211) % (assembler.canvasSize[1] - 160) + rng.randrange(0, 100)
+        placedEntries.append((templateEntry, image, assembler.getPaletteIndices(np.array(image))))
+    
+    (referenceTime, (referenceCrops, referenceReport)) = timeCall(compositeExportGroupsRgba, placedEntries)
+    (planeTime, (planeCrops, planeReport)) = timeCall(compositeExportGroupsPlanes, placedEntries)
+    if referenceCrops != planeCrops:
+        raise RuntimeError("export group planes disagree with compositing full RGBA canvases")
+    
+    print("\tfull RGBA canvases {0:.3f}s, planes {1:.3f}s ({2:.1f}x)".format(referenceTime, planeTime, referenceTime / planeTime))
+    for (templateEntry, image, indices) in placedEntries:
+        image.close()
+    return {"rgba_canvases_seconds": referenceTime, "planes_seconds": planeTime}
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    # HTTP/1.1 so the fetcher can keep its connections alive
+    protocol_version = "HTTP/1.1"
+    
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        self.server.requestCount += 1
+        if not self.path in self.server.routes:
+            self.send_error(404)
+            return
+        body = self.server.routes[self.path]
+        etag = '"{0}"'.format(hashlib.sha256(body).hexdigest()[0:16])
+        if self.headers.get("If-None-Match") == etag:
+            self.server.notModifiedCount += 1
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.server.bytesSent += len(body)
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+def startStandInHost(latency):
+    # a local stand-in for an ally host which answers every request after a fixed delay
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.routes = dict()
+    server.requestCount = 0
+    server.notModifiedCount = 0
+    server.bytesSent = 0
+    server.rootUrl = "http://127.0.0.1:{0}/".format(server.server_address[1])
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
+
+def stopStandInHost(host):
+    host.shutdown()
+    host.server_close()
+
+def getHostCounters(hosts):
+    return {
+        "requests": sum(host.requestCount for host in hosts),
+        "not_modified": sum(host.notModifiedCount for host in hosts),
+        "bytes": sum(host.bytesSent for host in hosts),
+    }
+
+def encodePng(image):
+    with io.BytesIO() as output:
+        image.save(output, format = "PNG")
+        return output.getvalue()
+
+def benchmarkFetch(latencies = (0.1, 0.2, 0.3, 0.4), imagesPerHost = 4, fetchMargin = 0.5):
+    print("fetch {0} endu templates with {1} images each".format(len(latencies), imagesPerHost))
+    hosts = [startStandInHost(latency) for latency in latencies]
+    templateFile = {"endu_info": {"source_root": "https://example.invalid/"}, "templates": []}
+    for (hostIndex, host) in enumerate(hosts):
+        enduTemplate = {"templates": []}
+        for imageIndex in range(0, imagesPerHost):
+            imagePath = "/sprite{0}.png".format(imageIndex)
+            with generateSpriteImage((50, 50), seed = imageIndex) as sprite:
+                host.routes[imagePath] = encodePng(sprite)
+            enduTemplate["templates"].append({"name": "sprite{0}".format(imageIndex), "sources": [host.rootUrl + imagePath[1:]], "x": imageIndex * 50, "y": hostIndex * 50})
+        host.routes["/endu_template.json"] = json.dumps(enduTemplate).encode("utf-8")
+        templateFile["templates"].append({"name": "host{0}".format(hostIndex), "endu": host.rootUrl + "endu_template.json"})
+    
+    def fetchAll():
+        with assembler.RemoteFetcher() as fetcher:
+            templates = assembler.getTemplates(templateFile, fetcher)
+            assembler.prefetchTemplateImages(templates, fetcher, 0)
+            for templateEntry in templates:
+                assembler.loadTemplateEntryImage(templateEntry, ".", fetcher).close()
+            return len(templates)
+    
+    (fetchTime, (entryCount, fetchReport)) = timeCall(fetchAll)
+    if entryCount != len(hosts) * imagesPerHost:
+        raise RuntimeError("expected {0} entries from the stand-in hosts, got {1}".format(len(hosts) * imagesPerHost, entryCount))
+    
+    serialTime = sum(host.latency * host.requestCount for host in hosts)
+    slowestHostTime = max(host.latency * 2 for host in hosts)
+    print("\t{0:.3f}s concurrent, {1:.3f}s if fetched one after another, {2:.3f}s for the slowest host alone".format(fetchTime, serialTime, slowestHostTime))
+    for host in hosts:
+        stopStandInHost(host)
+    # the hosts are fetched side by side, so the wall clock follows the slowest one
+    if fetchTime >= slowestHostTime + fetchMargin:
+        raise RuntimeError("fetching took {0:.3f}s, more than the slowest host alone ({1:.3f}s) allows".format(fetchTime, slowestHostTime))
+    if fetchTime >= serialTime / 2:
+        raise RuntimeError("fetching took {0:.3f}s, not much faster than one host after another ({1:.3f}s)".format(fetchTime, serialTime))
+    return {"concurrent_seconds": fetchTime, "serial_estimate_seconds": serialTime, "slowest_host_seconds": slowestHostTime}
+
+def applyDelta(planes, deltaBytes):
+    # what a client does with deltas/<version>.bin, see encodeDelta
+    deltaData = zlib.decompress(deltaBytes)
+    if deltaData[0:4] != assembler.deltaMagic:
+        raise ValueError("not a delta")
+    headerFormat = "<BIIHHI"
+    (formatVersion, previousVersion, version, width, height, runCount) = struct.unpack_from(headerFormat, deltaData, 4)
+    offset = 4 + struct.calcsize(headerFormat)
+    runs = np.frombuffer(deltaData, dtype="<u2", count = runCount * 3, offset = offset).reshape(-1, 3)
+    offset += runs.nbytes
+    for name in ["canvas", "autopick", "mask"]:
+        for (x, y, length) in runs:
+            planes[name][y, x:x + length] = np.frombuffer(deltaData, dtype=np.uint8, count = length, offset = offset)
+            offset += length
+    if offset != len(deltaData):
+        raise ValueError("delta has trailing bytes")
+    return version
+
+def benchmarkDeltas(size = (1000, 1000), seed = 1):
+    # a typical small edit: one entry moved a few pixels, plus a handful of single pixel fixes
+    print("delta for a small edit on a {0}x{1} canvas".format(size[0], size[1]))
+    rng = np.random.default_rng(seed)
+    (width, height) = size
+    previousPlanes = {
+        "canvas": np.zeros((height, width), dtype=np.uint8),
+        "autopick": np.zeros((height, width), dtype=np.uint8),
+        "mask": np.zeros((height, width), dtype=np.uint8),
+    }
+    for i in range(0, 200):
+        (x, y) = (int(rng.integers(0, width - 60)), int(rng.integers(0, height - 60)))
+        previousPlanes["canvas"][y:y + 60, x:x + 60] = rng.integers(1, len(assembler.palette) + 1, (60, 60))
+    previousPlanes["autopick"][:, 0:width // 2] = previousPlanes["canvas"][:, 0:width // 2]
+    previousPlanes["mask"][:, 0:width // 2] = np.where(previousPlanes["autopick"][:, 0:width // 2] != 0, 200, 0)
+    
+    planes = dict((name, plane.copy()) for (name, plane) in previousPlanes.items())
+    for plane in planes.values():
+        plane[300:340, 400:460] = plane[302:342, 403:463]
+    for i in range(0, 50):
+        (x, y) = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        planes["canvas"][y, x] = int(rng.integers(1, len(assembler.palette) + 1))
+    
+    (deltaTime, (deltaBytes, deltaReport)) = timeCall(lambda: assembler.encodeDelta(1, 2, planes, assembler.findDeltaRuns(previousPlanes, planes)))
+    appliedPlanes = dict((name, plane.copy()) for (name, plane) in previousPlanes.items())
+    applyDelta(appliedPlanes, deltaBytes)
+    if not all(np.array_equal(appliedPlanes[name], planes[name]) for name in planes):
+        raise RuntimeError("applying the delta does not reproduce the new outputs")
+    
+    fullBytes = 0
+    for (name, plane) in planes.items():
+        with Image.frombytes("L", size, plane.tobytes()) as planeImage, io.BytesIO() as output:
+            planeImage.save(output, format = "PNG", compress_level = 9)
+            fullBytes += output.tell()
+    print("	{0} bytes of delta in {1:.3f}s, {2} bytes of full images".format(len(deltaBytes), deltaTime, fullBytes))
+    return {"delta_bytes": len(deltaBytes), "delta_seconds": deltaTime, "full_bytes": fullBytes}
+
+def readWorkQueue(filePath):
+    # what a bot does with work_queue.bin, see WorkQueue.write
+    with open(filePath, "rb") as f:
+        queueData = f.read()
+    if queueData[0:4] != assembler.workQueueMagic:
+        raise ValueError("not a work queue")
+    headerFormat = "<BIIHHI"
+    (formatVersion, version, revision, width, height, recordCount) = struct.unpack_from(headerFormat, queueData, 4)
+    return np.frombuffer(queueData, dtype=assembler.workQueueRecord, count = recordCount, offset = 4 + struct.calcsize(headerFormat))
+
+def benchmarkWorkQueue(size = (1000, 1000), snapshotCount = 20, seed = 1):
+    # a board close to autopick that a few hundred pixels change on between snapshots, compared with
+    # sorting a full scan of every snapshot the way bots do it client side
+    print("work queue for {0} snapshots of a {1}x{2} board".format(snapshotCount, size[0], size[1]))
+    rng = np.random.default_rng(seed)
+    (width, height) = size
+    autopick = np.zeros((height, width), dtype=np.uint8)
+    mask = np.zeros((height, width), dtype=np.uint8)
+    for i in range(0, 100):
+        (x, y) = (int(rng.integers(0, width - 80)), int(rng.integers(0, height - 80)))
+        autopick[y:y + 80, x:x + 80] = rng.integers(1, len(assembler.palette) + 1, (80, 80))
+        mask[y:y + 80, x:x + 80] = rng.integers(23, 256, (80, 80))
+    mask[autopick == 0] = 0
+    
+    boards = [np.where(autopick != 0, autopick, 1).astype(np.uint8)]
+    for i in range(1, snapshotCount):
+        board = boards[-1].copy()
+        for j in range(0, 300):
+            (x, y) = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+            board[y, x] = int(rng.integers(1, len(assembler.palette) + 1))
+        boards.append(board)
+    
+    folder = tempfile.mkdtemp(prefix = "work_queue_")
+    try:
+        assembler.writePlane(autopick, folder, "autopick")
+        assembler.writePlane(autopick, folder, "canvas")
+        assembler.writePlane(mask, folder, "mask", isMask = True)
+        workQueue = assembler.WorkQueue(folder)
+        
+        updateTime = 0
+        for board in boards:
+            startTime = time.perf_counter()
+            workQueue.update(board)
+            workQueue.write()
+            updateTime += time.perf_counter() - startTime
+        records = readWorkQueue(os.path.join(folder, assembler.workQueueFile))
+        
+        startTime = time.perf_counter()
+        for board in boards:
+            (ys, xs) = np.nonzero((autopick != 0) & (board != autopick))
+            scanOrder = np.lexsort((xs, ys, 255 - mask[ys, xs]))
+        scanTime = time.perf_counter() - startTime
+    finally:
+        shutil.rmtree(folder)
+    
+    if not (np.array_equal(records["x"], xs[scanOrder]) and np.array_equal(records["y"], ys[scanOrder]) and
+        np.array_equal(records["index"], autopick[ys, xs][scanOrder]) and np.array_equal(records["priority"], mask[ys, xs][scanOrder])):
+        raise RuntimeError("the work queue differs from a full scan of the last snapshot")
+    print("\t{0} records, {1:.4f}s per snapshot, full scans {2:.4f}s per snapshot".format(len(records), updateTime / snapshotCount, scanTime / snapshotCount))
+    return {"records": len(records), "update_seconds": updateTime / snapshotCount, "scan_seconds": scanTime / snapshotCount}
+
+def checkAnimatedCulling():
+    # an animation over a local entry: its active frame covers the entry, its other frame doesn't. once the
+    # cache knows the coverage, culling must not change the patches the other frame shows the entry through
+    print("animation over a local entry, built cold, warm and without culling")
+    host = startStandInHost(0)
+    workFolder = tempfile.mkdtemp(prefix = "animated_culling_")
+    templateFolder = os.path.join(workFolder, "template")
+    os.makedirs(os.path.join(templateFolder, "source"))
+    
+    sheet = np.zeros((20, 40, 4), dtype=np.uint8)
+    sheet[:, 0:20] = assembler.paletteArray[0]
+    host.routes["/sheet.png"] = encodePng(Image.fromarray(sheet))
+    enduTemplate = {"templates": [{"name": "blink", "sources": [host.rootUrl + "sheet.png"], "x": 10, "y": 10,
+        "frameWidth": 20, "frameHeight": 20, "frameRate": 3600, "frameCount": 2, "startTime": time.time()}]}
+    host.routes["/blink.json"] = json.dumps(enduTemplate).encode("utf-8")
+    with Image.new("RGBA", (10, 10), tuple(int(value) for value in assembler.paletteArray[1])) as underImage:
+        underImage.save(os.path.join(templateFolder, "source", "under.png"))
+    templateFile = {
+        "endu_info": {"contact": "benchmark", "source_root": "https://example.invalid/benchmark/", "name": "benchmark"},
+        # listed first, so the animation is drawn over the entry
+        "templates": [
+            {"name": "ally", "endu": host.rootUrl + "blink.json", "autopick": True},
+            {"name": "under", "images": ["source/under.png"], "x": 15, "y": 15, "autopick": True},
+        ],
+    }
+    with open(os.path.join(templateFolder, "template.json"), "w", encoding="utf-8") as f:
+        f.write(json.dumps(templateFile, indent = 4))
+    
+    previousSettings = dict(assembler.renderSettings)
+    outputs = dict()
+    try:
+        assembler.renderSettings["workers"] = 1
+        for (build, cull) in [("cold", True), ("warm", True), ("no_cull", False)]:
+            assembler.renderSettings["cull"] = cull
+            cache = assembler.FetchCache(os.path.join(workFolder, "cache"), assembler.defaultCacheMegabytes * 1048576)
+            with contextlib.redirect_stdout(io.StringIO()):
+                assembler.main(templateFolder, cache)
+            outputs[build] = hashOutputs(templateFolder)
+    finally:
+        assembler.renderSettings.update(previousSettings)
+        stopStandInHost(host)
+        shutil.rmtree(workFolder)
+    
+    patches = [name for name in outputs["no_cull"] if name.startswith(assembler.animationFolder)]
+    if len(patches) == 0:
+        raise RuntimeError("the animation has no patches")
+    if not outputs["cold"] == outputs["warm"] == outputs["no_cull"]:
+        raise RuntimeError("culling changes the outputs of an animated folder")
+    print("\t{0} patches, identical in all three builds".format(len(patches)))
+    return {"patches": len(patches)}
+
+def generateEntryImage(size, noiseRatio, transparentRatio, rng):
+    # palette colored blobs until roughly 1 - transparentRatio of the image is covered
+    paletteColors = list(assembler.palette)
+    image = Image.new("RGBA", size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    targetCoverage = 1 - transparentRatio
+    while np.count_nonzero(np.array(image.getchannel("A"))) < targetCoverage * size[0] * size[1]:
+        for i in range(0, 4):
+            (x, y) = (rng.integers(0, size[0]), rng.integers(0, size[1]))
+            radius = rng.integers(2, max(3, min(size) // 4))
+            draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill = paletteColors[rng.integers(0, len(paletteColors))])
+    
+    # nudged off the palette like compression artifacts would, close enough that autopick survives normalizing
+    pixels = np.array(image).astype(np.int16)
+    noisy = (pixels[..., 3] > 0) & (rng.random(pixels.shape[0:2]) < noiseRatio)
+    pixels[noisy, 0:3] += rng.integers(-4, 5, (np.count_nonzero(noisy), 3), dtype = np.int16)
+    pixels = np.clip(pixels, 0, 255).astype(np.uint8)
+    return Image.frombytes("RGBA", size, pixels.tobytes())
+
+def placeEntry(size, groupIndex, config, rng):
+    (canvasWidth, canvasHeight) = config["canvas_size"]
+    if groupIndex is None:
+        return (int(rng.integers(0, canvasWidth - size[0])), int(rng.integers(0, canvasHeight - size[1])))
+    # members of a group stay close to each other like real export groups do
+    anchorX = (groupIndex * 283) % (canvasWidth - config["max_size"] - 150)
+    anchorY = (groupIndex * 419) % (canvasHeight - config["max_size"] - 150)
+    return (anchorX + int(rng.integers(0, 150)), anchorY + int(rng.integers(0, 150)))
+
+def generateTemplateFolder(folder, config, hosts):
+    # a synthetic template.json folder: local entries plus Endu references served by the stand-in hosts
+    rng = np.random.default_rng(config["seed"])
+    os.makedirs(os.path.join(folder, "source"), exist_ok = True)
+    
+    def generateEntry(name):
+        size = (int(rng.integers(config["min_size"], config["max_size"] + 1)), int(rng.integers(config["min_size"], config["max_size"] + 1)))
+        groupIndex = None
+        if config["groups"] > 0 and rng.random() < 0.5:
+            groupIndex = int(rng.integers(0, config["groups"]))
+        (x, y) = placeEntry(size, groupIndex, config, rng)
+        with generateEntryImage(size, config["noise"], config["transparency"], rng) as image:
+            return (encodePng(image), {"name": name, "x": x, "y": y}, groupIndex)
+    
+    templates = []
+    for entryIndex in range(0, config["entries"]):
+        (imageBytes, templateEntry, groupIndex) = generateEntry("entry{0}".format(entryIndex))
+        with open(os.path.join(folder, "source", templateEntry["name"] + ".png"), "wb") as f:
+            f.write(imageBytes)
+        templateEntry["images"] = ["source/" + templateEntry["name"] + ".png"]
+        templateEntry["priority"] = int(rng.integers(1, 11))
+        templateEntry["autopick"] = bool(rng.random() < 0.5)
+        if groupIndex is not None:
+            templateEntry["export_group"] = "group{0}".format(groupIndex)
+        templates.append(templateEntry)
+    
+    for referenceIndex in range(0, config["endu_refs"]):
+        host = hosts[referenceIndex % len(hosts)]
+        enduTemplate = {"faction": "ally{0}".format(referenceIndex), "templates": []}
+        for entryIndex in range(0, config["endu_entries"]):
+            (imageBytes, enduEntry, groupIndex) = generateEntry("ally{0}_{1}".format(referenceIndex, entryIndex))
+            host.routes["/" + enduEntry["name"] + ".png"] = imageBytes
+            enduEntry["sources"] = [host.rootUrl + enduEntry["name"] + ".png"]
+            enduTemplate["templates"].append(enduEntry)
+        host.routes["/ally{0}.json".format(referenceIndex)] = json.dumps(enduTemplate).encode("utf-8")
+        templates.append({"name": "ally{0}".format(referenceIndex), "endu": host.rootUrl + "ally{0}.json".format(referenceIndex), "priority": 1, "autopick": True})
+    
+    templateFile = {
+        "endu_info": {"contact": "benchmark", "source_root": "https://example.invalid/benchmark/", "name": "benchmark"},
+        "canvas_size": list(config["canvas_size"]),
+        "templates": templates,
+    }
+    with open(os.path.join(folder, "template.json"), "w", encoding="utf-8") as f:
+        f.write(json.dumps(templateFile, indent = 4))
+
+def hashOutputs(folder):
+    # everything a build publishes that doesn't depend on the version it was
+    outputHashes = dict()
+    for (directory, directoryNames, fileNames) in os.walk(folder):
+        for fileName in fileNames:
+            filePath = os.path.join(directory, fileName)
+            if fileName.endswith(".png") or fileName in ["endu_template.json", "tiles.json"]:
+                outputHashes[os.path.relpath(filePath, folder)] = assembler.hashFile(filePath)
+    return outputHashes
+
+def runBuildScenario(folder, cacheDir, incremental, tileSize, workers):
+    # runs in a fresh process so that peak memory belongs to this build alone
+    assembler.outputSettings["tile_size"] = tileSize
+    assembler.renderSettings["workers"] = workers
+    cache = assembler.FetchCache(cacheDir, assembler.defaultCacheMegabytes * 1048576) if cacheDir else None
+    
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        assembler.main(folder, cache, incremental)
+    totalTime = time.perf_counter() - start
+    
+    with open(os.path.join(folder, "build_report.json"), "r", encoding="utf-8") as f:
+        buildReport = json.loads(f.read())
+    
+    # whole-build stages plus the per-entry stages they are made of
+    stages = dict(buildReport["stages"])
+    for stage in assembler.reportEntryStages + ["fetch"]:
+        stages["entries_" + stage] = buildReport["totals"][stage + "_seconds"]
+    return {"total_seconds": totalTime, "outcome": buildReport["outcome"], "stages": stages, "peak_rss_mb": buildReport["totals"]["peak_rss_mb"], "culled_entries": buildReport["totals"]["culled_entries"], "outputs": hashOutputs(folder)}
+
+def benchmarkBuild(config):
+    print("build {0} local entries, {1} endu references with {2} entries each, {3} export groups, {4}x{5} canvas".format(config["entries"], config["endu_refs"], config["endu_entries"], config["groups"], *config["canvas_size"]))
+    hosts = [startStandInHost(config["latency"]) for i in range(0, max(1, config["hosts"]))]
+    workFolder = tempfile.mkdtemp(prefix = "assembler_benchmark_")
+    templateFolder = os.path.join(workFolder, "template")
+    cacheDir = os.path.join(workFolder, "cache")
+    generateTemplateFolder(templateFolder, config, hosts)
+    
+    # cold has no cache, the others share one that the first of them fills. cold_serial decodes every
+    # entry in the build's own process and has to publish exactly what cold did with the worker pipeline
+    scenarios = [
+        ("cold", None, False, config["workers"]),
+        ("cold_serial", None, False, 1),
+        ("cache_fill", cacheDir, False, config["workers"]),
+        ("cached", cacheDir, False, config["workers"]),
+        ("incremental_first", cacheDir, True, config["workers"]),
+        ("incremental_noop", cacheDir, True, config["workers"]),
+    ]
+    
+    results = dict()
+    spawnContext = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers = 1, mp_context = spawnContext, max_tasks_per_child = 1) as pool:
+        for (scenario, scenarioCacheDir, incremental, workers) in scenarios:
+            countersBefore = getHostCounters(hosts)
+            result = pool.submit(runBuildScenario, templateFolder, scenarioCacheDir, incremental, config["tile_size"], workers).result()
+            countersAfter = getHostCounters(hosts)
+            result["remote"] = dict((counter, countersAfter[counter] - countersBefore[counter]) for counter in countersAfter)
+            results[scenario] = result
+            
+            stages = ", ".join("{0} {1:.3f}s".format(stage, seconds) for (stage, seconds) in sorted(result["stages"].items(), key = lambda item: -item[1]))
+            print("\t{0:<18} {1:.3f}s, peak {2:.0f} MB, {3} requests ({4} not modified, {5} bytes), {6} entries culled".format(scenario, result["total_seconds"], result["peak_rss_mb"] or 0, result["remote"]["requests"], result["remote"]["not_modified"], result["remote"]["bytes"], result["culled_entries"]))
+            print("\t\t{0}".format(stages))
+    
+    results["serial_identical"] = results["cold"]["outputs"] == results["cold_serial"]["outputs"]
+    print("\tserial and pipelined outputs identical: {0}".format(results["serial_identical"]))
+    if not results["serial_identical"]:
+        print("\tFAILED: pipelined decoding changed the outputs")
+    results["passed"] = results["serial_identical"]
+    
+    for host in hosts:
+        stopStandInHost(host)
+    if config["keep"]:
+        print("\tsynthetic template kept in {0}".format(templateFolder))
+    else:
+        shutil.rmtree(workFolder)
+    return results
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description = "Benchmarks the template assembler and checks its optimized code paths against the reference implementations")
+    parser.add_argument("--suite", choices = ["micro", "build", "all"], default = "all", help = "micro benchmarks of single functions, whole builds of a synthetic template, or both")
+    parser.add_argument("--entries", type = int, default = 40, help = "local entries in the synthetic template")
+    parser.add_argument("--min-size", type = int, default = 20, help = "smallest entry image width or height")
+    parser.add_argument("--max-size", type = int, default = 200, help = "largest entry image width or height")
+    parser.add_argument("--noise", type = float, default = 0.02, help = "fraction of opaque pixels nudged off the palette")
+    parser.add_argument("--transparency", type = float, default = 0.4, help = "fraction of each image left transparent")
+    parser.add_argument("--groups", type = int, default = 3, help = "export groups that about half of the entries join")
+    parser.add_argument("--endu-refs", type = int, default = 4, help = "Endu template references served by the stand-in hosts")
+    parser.add_argument("--endu-entries", type = int, default = 4, help = "entries in each referenced Endu template")
+    parser.add_argument("--hosts", type = int, default = 2, help = "stand-in hosts the Endu references are spread over")
+    parser.add_argument("--latency", type = float, default = 0.05, help = "seconds every stand-in host waits before answering")
+    parser.add_argument("--canvas-size", type = int, nargs = 2, default = list(assembler.defaultCanvasSize), metavar = ("WIDTH", "HEIGHT"), help = "canvas size of the synthetic template")
+    parser.add_argument("--tile-size", type = int, default = 0, help = "build the synthetic template with tiled output (default: no tiles)")
+    parser.add_argument("--workers", type = int, default = None, help = "processes decoding entries in the builds (default: one per cpu)")
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--json", help = "write the results to this file instead of printing them")
+    parser.add_argument("--keep", action = "store_true", help = "keep the synthetic template folder")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    arguments = parseArguments()
+    config = vars(arguments)
+    results = {"config": config, "python": sys.version.split()[0], "platform": sys.platform}
+    
+    if arguments.suite in ["micro", "all"]:
+        results["micro"] = {
+            "normalize": benchmarkNormalize(),
+            "priority_mask": benchmarkPriorityMask(),
+            "small_priority_masks": checkSmallPriorityMasks(),
+            "shipped_priority_masks": checkShippedPriorityMasks(),
+            "source_regions": checkSourceRegions(),
+            "export_groups": benchmarkExportGroups(),
+            "fetch": benchmarkFetch(),
+            "deltas": benchmarkDeltas(),
+            "work_queue": benchmarkWorkQueue(),
+            "animated_culling": checkAnimatedCulling(),
+        }
+    if arguments.suite in ["build", "all"]:
+        results["build"] = benchmarkBuild(config)
+    
+    if arguments.json:
+        with open(arguments.json, "w", encoding="utf-8") as f:
+            f.write(json.dumps(results, indent = 4))
+    else:
+        print(json.dumps(results, indent = 4))
+    
+    # checks that could not run report passed: false instead of raising, so the others still run
+    failed = [name for (name, result) in results.get("micro", dict()).items() if result.get("passed") is False]
+    if "build" in results and results["build"]["passed"] is False:
+        failed.append("build")
+    if len(failed) > 0:
+        print("failed: {0}".format(", ".join(failed)))
+        sys.exit(1)